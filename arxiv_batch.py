@@ -0,0 +1,245 @@
+import asyncio, difflib, os, re, time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from arxiv_index import ArxivIndex, normalize_title, parse_atom, query_key
+from cancellation import current_token
+from downloads import DOWNLOAD_STATE_FOLDER, astream_download
+
+
+### Batch retrieval of a whole bibliography from arXiv without the LLM loop of
+### ArxivRetrievalWorkflow. The entries are turned into API queries up front,
+### then resolved and downloaded concurrently over one pooled HTTP client.
+### arXiv asks for no more than one API request every three seconds, so every
+### host gets its own limiter that spaces out the start of the requests.
+ARXIV_API_URL = "https://export.arxiv.org/api/query"
+ARXIV_PDF_URL = "https://arxiv.org/pdf"
+PDF_FOLDER = os.path.join("files", "pdfs")
+# "[3]", "3." or "3)" in front of an entry
+LABEL = r"(?:\[\d+\]|\d+[.)])"
+# A label starts an entry at the start of a line, or right after the end of
+# the previous one when followed by a capital (the first author). Numbers
+# inside an entry (volumes, pages, years) are neither.
+LEADING_LABEL = re.compile(rf"^\s*{LABEL}\s*")
+NEXT_LABEL = re.compile(rf"(?<=[.;])\s+(?={LABEL}\s+[A-ZÀ-Ý])")
+STOPWORDS = {"the", "and", "for", "with", "from", "into", "onto", "via", "its", "are"}
+
+
+class RateLimiter:
+    """Lets one request start every `interval` seconds."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = asyncio.Lock()
+        self._next_start = 0.0
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            if self._next_start > now:
+                await asyncio.sleep(self._next_start - now)
+            self._next_start = max(now, self._next_start) + self.interval
+
+
+def parse_bibliography(text):
+    """Splits a bibliography (one entry per line, or numbered entries such as
+    "1. ..., 2. ..." and "[3] ...") into a list of entries."""
+    text = re.sub(r'^\s*\w+\s*=\s*"""|"""\s*$', "", text.strip())
+    entries = []
+    for line in text.splitlines():
+        for part in NEXT_LABEL.split(line):
+            part = LEADING_LABEL.sub("", part, count=1).strip(" ,;")
+            if part:
+                entries.append(part)
+    return entries
+
+
+def title_of_entry(entry):
+    """Returns the title of a reference when it is marked up (italic or quoted),
+    otherwise the whole entry."""
+    match = re.search(r"_([^_]{8,})_|\*([^*]{8,})\*|[\"“]([^\"”]{8,})[\"”]", entry)
+    if match:
+        return next(group for group in match.groups() if group).strip()
+    return entry
+
+
+def query_for_title(title, max_words=8):
+    words = [
+        word
+        for word in re.findall(r"[A-Za-z0-9]+", title)
+        if len(word) > 2 and word.lower() not in STOPWORDS
+    ]
+    return " AND ".join(f"ti:{word}" for word in words[:max_words])
+
+
+def filename_from_title(title, max_words=4):
+    return "_".join(re.findall(r"[A-Za-z0-9]+", title)[:max_words])
+
+
+def run_sync(coroutine):
+    """Runs a coroutine to completion, also from code (like a notebook) that
+    already has an event loop running in this thread."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+class ArxivBatchRetriever:
+    def __init__(
+        self,
+        api_url=ARXIV_API_URL,
+        pdf_url=ARXIV_PDF_URL,
+        folder=PDF_FOLDER,
+        api_interval=3.0,
+        pdf_interval=1.0,
+        max_connections=4,
+        max_results=5,
+        min_similarity=0.6,
+        index=None,
+        state_folder=DOWNLOAD_STATE_FOLDER,
+    ):
+        self.api_url = api_url
+        self.pdf_url = pdf_url
+        self.folder = folder
+        self.api_interval = api_interval
+        self.pdf_interval = pdf_interval
+        self.max_connections = max_connections
+        self.max_results = max_results
+        # Matches that look less like the requested title are not downloaded
+        self.min_similarity = min_similarity
+        # Partial downloads, kept there to be resumed
+        self.state_folder = state_folder
+        # Titles already in the local metadata index skip the API altogether
+        if index == None:
+            self.index = ArxivIndex()
+        else:
+            self.index = index
+
+    async def search(self, client, limiter, title):
+        cached = self.index.by_title(title, self.max_results)
+        if cached:
+            return cached
+        key = query_key(query_for_title(title), self.max_results)
+        cached = self.index.by_query(key)
+        if cached != None:
+            return cached
+        await limiter.wait()
+        response = await client.get(
+            self.api_url,
+            params={
+                "search_query": query_for_title(title),
+                "max_results": self.max_results,
+            },
+        )
+        response.raise_for_status()
+        entries = parse_atom(response.text)
+        self.index.add(entries)
+        self.index.add_query(key, entries)
+        return entries
+
+    def best_match(self, title, candidates):
+        wanted = normalize_title(title)
+        scored = [
+            (
+                difflib.SequenceMatcher(
+                    None, wanted, normalize_title(candidate["title"])
+                ).ratio(),
+                candidate,
+            )
+            for candidate in candidates
+        ]
+        if not scored:
+            return None
+        score, candidate = max(scored, key=lambda pair: pair[0])
+        return candidate if score >= self.min_similarity else None
+
+    async def download(self, client, limiter, arxiv_id, save_path):
+        """Downloads the PDF like download_pdf does (resumable, checked before
+        it takes its name). Returns False without a request if the PDF is
+        already there."""
+        if os.path.exists(save_path):
+            return False
+        await limiter.wait()
+        await astream_download(
+            client,
+            f"{self.pdf_url}/{arxiv_id}.pdf",
+            save_path,
+            state_folder=self.state_folder,
+        )
+        return True
+
+    async def retrieve_entry(self, client, limiters, entry, token=None):
+        title = title_of_entry(entry)
+        stopped = {"query": title, "error": "skipped, the run was stopped"}
+        try:
+            if token != None and token.cancelled:
+                return stopped
+            match = self.best_match(
+                title, await self.search(client, limiters["api"], title)
+            )
+            if match is None:
+                return {"query": title, "error": "no matching paper on arXiv"}
+            save_path = os.path.join(
+                self.folder, f"{filename_from_title(match['title'])}.pdf"
+            )
+            if token != None and token.cancelled:
+                return stopped
+            downloaded = await self.download(
+                client, limiters["pdf"], match["id"], save_path
+            )
+            return {
+                "query": title,
+                "paper": match,
+                "path": save_path,
+                "downloaded": downloaded,
+            }
+        except (httpx.HTTPError, ET.ParseError, OSError) as e:
+            return {"query": title, "error": str(e)}
+
+    async def retrieve_all(self, entries, token=None):
+        limiters = {
+            "api": RateLimiter(self.api_interval),
+            "pdf": RateLimiter(self.pdf_interval),
+        }
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections,
+        )
+        async with httpx.AsyncClient(
+            limits=limits, timeout=60.0, follow_redirects=True
+        ) as client:
+            return await asyncio.gather(
+                *(
+                    self.retrieve_entry(client, limiters, entry, token)
+                    for entry in entries
+                )
+            )
+
+    def retrieve(self, bibliography):
+        """Retrieves every entry of the bibliography and returns a report. The
+        entries not started when the current run is cancelled are skipped."""
+        entries = parse_bibliography(bibliography)
+        print(f"Retrieving {len(entries)} papers from arXiv")
+        os.makedirs(self.folder, exist_ok=True)
+        results = run_sync(self.retrieve_all(entries, current_token.get()))
+        report = []
+        for result in results:
+            if "error" in result:
+                report.append(
+                    f"The paper '{result['query']}' could not be retrieved: {result['error']}"
+                )
+            elif not result["downloaded"]:
+                report.append(
+                    f"The paper with the title '{result['paper']['title']}' is already in {result['path']}"
+                )
+            else:
+                report.append(
+                    f"The paper with the title '{result['paper']['title']}' has sucessfully been downloaded to {result['path']}"
+                )
+        report.append("We are done.")
+        report = "\n".join(report)
+        print(report)
+        return report
@@ -0,0 +1,279 @@
+import difflib, json, os, re, sqlite3, threading, time
+import xml.etree.ElementTree as ET
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+
+### Local index of the arXiv metadata we have already seen. Every API response
+### is parsed and stored, together with the search query that produced it.
+### A query asked before, a lookup by id and a lookup by (nearly) the complete
+### title of a paper are answered from here before going to the network. A
+### keyword search is only answered from the response it got the last time,
+### never from the papers that happen to be in the index, so new papers can
+### still be found. Only Atom feeds are stored as answers; a search that found
+### nothing is asked again after an hour rather than after ttl_days.
+ATOM = {"atom": "http://www.w3.org/2005/Atom"}
+INDEX_PATH = os.path.join("files", "cache", "arxiv_index.sqlite")
+
+
+def normalize_title(title):
+    return " ".join(re.findall(r"[a-z0-9]+", title.lower()))
+
+
+def parse_atom(xml_text):
+    """Extracts id, version, title, authors and abstract of every entry of an
+    arXiv API response."""
+    feed = ET.fromstring(xml_text)
+    if feed.tag != f"{{{ATOM['atom']}}}feed":
+        raise ET.ParseError(f"expected an Atom feed, got <{feed.tag}>")
+    entries = []
+    for entry in feed.findall("atom:entry", ATOM):
+        url = entry.findtext("atom:id", "", ATOM).strip()
+        match = re.search(r"abs/(.+?)(v\d+)?$", url)
+        if match is None:
+            continue
+        entries.append(
+            {
+                "id": match.group(1),
+                "version": match.group(2) or "",
+                "title": " ".join(entry.findtext("atom:title", "", ATOM).split()),
+                "authors": [
+                    author.findtext("atom:name", "", ATOM).strip()
+                    for author in entry.findall("atom:author", ATOM)
+                ],
+                "abstract": " ".join(entry.findtext("atom:summary", "", ATOM).split()),
+            }
+        )
+    return entries
+
+
+def read_entries(text):
+    """Like parse_atom, but returns no entries for text that is not Atom XML
+    (the error messages of get_id_from_url for example)."""
+    try:
+        return parse_atom(text)
+    except ET.ParseError:
+        return []
+
+
+def best_entry(query, entries):
+    """Returns the entry whose title fits the query best: most query words in
+    the title first, closest spelling second."""
+    query = normalize_title(query)
+
+    def score(entry):
+        title = normalize_title(entry["title"])
+        overlap = len(set(query.split()) & set(title.split()))
+        return overlap, difflib.SequenceMatcher(None, query, title).ratio()
+
+    return max(entries, key=score)
+
+
+def to_atom(entries):
+    """Writes entries back as a minimal arXiv API response."""
+    feed = ['<feed xmlns="http://www.w3.org/2005/Atom">']
+    for entry in entries:
+        feed.append("<entry>")
+        feed.append(
+            f"<id>http://arxiv.org/abs/{escape(entry['id'] + entry['version'])}</id>"
+        )
+        feed.append(f"<title>{escape(entry['title'])}</title>")
+        feed.append(f"<summary>{escape(entry['abstract'])}</summary>")
+        for author in entry["authors"]:
+            feed.append(f"<author><name>{escape(author)}</name></author>")
+        feed.append("</entry>")
+    feed.append("</feed>")
+    return "\n".join(feed)
+
+
+def query_key(search_query, max_results=5):
+    """The cache key of a search: the query as written, case and spacing aside."""
+    return f"{' '.join(search_query.lower().split())}|{max_results}"
+
+
+def search_key_from_url(url):
+    """The cache key of the search of an API url, or None if it is no search."""
+    parameters = parse_qs(urlparse(url).query)
+    search_query = " ".join(parameters.get("search_query", []))
+    if not search_query.strip():
+        return None
+    return query_key(search_query, parameters.get("max_results", ["5"])[0])
+
+
+def query_from_url(url):
+    """Returns (words of the search query, requested ids) of an arXiv API url."""
+    parameters = parse_qs(urlparse(url).query)
+    ids = [
+        re.sub(r"v\d+$", "", arxiv_id)
+        for value in parameters.get("id_list", [])
+        for arxiv_id in value.split(",")
+        if arxiv_id
+    ]
+    query = " ".join(parameters.get("search_query", []))
+    query = re.sub(r"\b(ti|abs|au|all|cat|co|jr|rn):", " ", query)
+    query = re.sub(r"\b(AND|OR|ANDNOT)\b", " ", query)
+    return normalize_title(query), ids
+
+
+class ArxivIndex:
+    def __init__(
+        self,
+        database_path=INDEX_PATH,
+        ttl_days=30,
+        min_similarity=0.9,
+        empty_ttl_hours=1,
+    ):
+        self.database_path = database_path
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.empty_ttl = empty_ttl_hours * 60 * 60
+        self.min_similarity = min_similarity
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(database_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS papers (
+                arxiv_id TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                title TEXT NOT NULL,
+                normalized_title TEXT NOT NULL,
+                authors TEXT NOT NULL,
+                abstract TEXT NOT NULL,
+                fetched REAL NOT NULL
+            )"""
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS papers_title ON papers (normalized_title)"
+        )
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS queries (
+                query TEXT PRIMARY KEY,
+                ids TEXT NOT NULL,
+                fetched REAL NOT NULL
+            )"""
+        )
+        self._connection.commit()
+
+    def add(self, entries):
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        entry["id"],
+                        entry["version"],
+                        entry["title"],
+                        normalize_title(entry["title"]),
+                        json.dumps(entry["authors"]),
+                        entry["abstract"],
+                        now,
+                    )
+                    for entry in entries
+                ],
+            )
+            self._connection.commit()
+
+    def add_response(self, xml_text, url=None):
+        """Stores every entry of an API response, and the search of the url it
+        answered, and returns the entries. Anything but an Atom feed (an error
+        page, an empty body) is no answer and is not stored."""
+        try:
+            entries = parse_atom(xml_text)
+        except ET.ParseError:
+            return []
+        self.add(entries)
+        if url != None and search_key_from_url(url) != None:
+            self.add_query(search_key_from_url(url), entries)
+        return entries
+
+    def add_query(self, key, entries):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, ?)",
+                (key, json.dumps([entry["id"] for entry in entries]), time.time()),
+            )
+            self._connection.commit()
+
+    def by_query(self, key):
+        """The entries of a search asked before, in their order, or None."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT ids, fetched FROM queries WHERE query = ? AND fetched >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        if row is None:
+            return None
+        ids = json.loads(row[0])
+        if not ids:
+            # The paper may just not be out yet
+            return [] if row[1] >= time.time() - self.empty_ttl else None
+        entries = {entry["id"]: entry for entry in self.by_ids(ids)}
+        # A paper of the answer is gone from the index: ask again
+        if len(entries) < len(set(ids)):
+            return None
+        return [entries[arxiv_id] for arxiv_id in ids]
+
+    def _rows(self, where, parameters):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT arxiv_id, version, title, normalized_title, authors, abstract FROM papers "
+                f"WHERE fetched >= ? AND {where}",
+                (time.time() - self.ttl, *parameters),
+            ).fetchall()
+        return [
+            {
+                "id": row[0],
+                "version": row[1],
+                "title": row[2],
+                "normalized_title": row[3],
+                "authors": json.loads(row[4]),
+                "abstract": row[5],
+            }
+            for row in rows
+        ]
+
+    def by_ids(self, ids):
+        entries = self._rows(
+            f"arxiv_id IN ({', '.join('?' * len(ids))})", ids
+        )
+        return entries if len(entries) == len(set(ids)) else []
+
+    def by_title(self, query, max_results=5):
+        """Looks a complete title up: an exact match of the normalized title
+        first, otherwise the titles at least min_similarity alike. A few
+        keywords are no title, so they match nothing here."""
+        query = normalize_title(query)
+        if not query:
+            return []
+        exact = self._rows("normalized_title = ?", (query,))
+        if exact:
+            return exact[:max_results]
+        words = query.split()
+        # Only titles sharing the longest word of the query are compared
+        anchor = max(words, key=len)
+        scored = []
+        for entry in self._rows("normalized_title LIKE ?", (f"%{anchor}%",)):
+            matcher = difflib.SequenceMatcher(None, query, entry["normalized_title"])
+            if matcher.quick_ratio() >= self.min_similarity:
+                ratio = matcher.ratio()
+                if ratio >= self.min_similarity:
+                    scored.append((ratio, entry))
+        scored.sort(key=lambda pair: -pair[0])
+        return [entry for _, entry in scored[:max_results]]
+
+    def lookup_url(self, url):
+        """Answers an arXiv API url from the index, as Atom XML, or returns None."""
+        query, ids = query_from_url(url)
+        key = search_key_from_url(url)
+        cached = self.by_query(key) if key != None else None
+        if ids:
+            entries = self.by_ids(ids)
+        elif cached != None:
+            # The very same search was answered before, even if with nothing
+            return to_atom(cached)
+        else:
+            max_results = parse_qs(urlparse(url).query).get("max_results", ["5"])[0]
+            entries = self.by_title(query, int(max_results) if max_results.isdigit() else 5)
+        if not entries:
+            return None
+        return to_atom(entries)
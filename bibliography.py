@@ -0,0 +1,312 @@
+import re
+from collections import deque
+
+
+### Rule-based handling of bibliographies. The references section of a
+### Nougat/MuPDF markdown is located and parsed into entries (key, authors,
+### title, year), and the in-text markers of a chunk ([12], [3-5],
+### (Author, 2020), Author et al. (2020)) are resolved against those entries.
+### Only the entries the parser cannot make sense of are left to the LLM.
+REFERENCES_HEADING = re.compile(
+    r"^(?:#{1,6}\s*|\*\*\s*)?(?:\d+\.?\s*)?(References|Bibliography|Literature|Works Cited|Literatur|Références|Bibliografia)\s*(?:\*\*)?\s*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+NEXT_SECTION = re.compile(r"^(?:#{1,6}\s+|\*\*)(?:Appendix|[A-Z]\.?\s)", re.MULTILINE)
+NUMERIC_MARKER = re.compile(r"\[(\d+(?:\s*[-–,]\s*\d+)*)\]")
+LEADING_LABEL = re.compile(r"^\s*(?:[-*•]\s*)?(?:\[(\d+)\]|(\d+)[.)])\s*")
+ENTRY_START = re.compile(r"^\s*(?:[-*•]\s+|\[\d+\]|\d+[.)]\s)")
+YEAR = re.compile(r"\b(?:19|20)\d{2}[a-z]?\b")
+PARENTHESIZED_YEAR = re.compile(r"\(((?:19|20)\d{2}[a-z]?)\)")
+MARKED_TITLE = re.compile(r"_([^_]{8,})_|\*([^*]{8,})\*|[\"“]([^\"”]{8,})[\"”]")
+APA_ENTRY = re.compile(r"^(.*?)\s*\((?:19|20)\d{2}[a-z]?\)\.?\s*(.+?)\.(?:\s|$)")
+INITIAL = r"[A-ZÀ-Ý][a-z]?\.(?:-?[A-ZÀ-Ý][a-z]?\.)*"
+PARTICLE = r"(?:van|von|der|de|di|da|del|la|le|du)\s+"
+SURNAME_WORD = r"[A-ZÀ-Ý][\w'’\-]+"
+INITIALS_FIRST = re.compile(
+    rf"^(?:{INITIAL}\s*)+(?:{PARTICLE})*{SURNAME_WORD}(?:\s+{SURNAME_WORD})?$"
+)
+INITIALS_LAST = re.compile(
+    rf"^(?:{PARTICLE})*{SURNAME_WORD}(?:\s+{SURNAME_WORD})?,?\s+(?:{INITIAL}\s*)+$"
+)
+AUTHOR_SEPARATOR = re.compile(r",?\s+et\s+al\.?,?\s*|,\s+|\s+and\s+|\s+&\s+|:\s+")
+NAME_PARTICLES = {"van", "von", "der", "de", "di", "da", "del", "la", "le", "du"}
+
+
+class AhoCorasick:
+    """Finds every occurrence of a set of words in a text in a single pass."""
+
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for word in set(words):
+            state = 0
+            for character in word:
+                if character not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][character] = len(self.goto) - 1
+                state = self.goto[state][character]
+            self.output[state].append(word)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and character not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(character, 0)
+                if self.fail[next_state] == next_state:
+                    self.fail[next_state] = 0
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def find(self, text):
+        """Yields (start, word) for every whole-word occurrence."""
+        state = 0
+        for position, character in enumerate(text):
+            while state and character not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(character, 0)
+            for word in self.output[state]:
+                start = position - len(word) + 1
+                end = position + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (
+                    end == len(text) or not text[end].isalnum()
+                ):
+                    yield start, word
+
+
+def expand_marker(marker):
+    """"3, 5-7" -> {"3", "5", "6", "7"}"""
+    labels = set()
+    for part in re.split(r"\s*,\s*", marker):
+        bounds = re.split(r"\s*[-–]\s*", part)
+        if len(bounds) == 2 and bounds[0].isdigit() and bounds[1].isdigit():
+            first, last = int(bounds[0]), int(bounds[1])
+            if 0 <= last - first <= 200:
+                labels.update(str(label) for label in range(first, last + 1))
+                continue
+        labels.update(bound for bound in bounds if bound.isdigit())
+    return labels
+
+
+def find_references_section(text):
+    """Returns (start, end) of the references section, or None."""
+    headings = list(REFERENCES_HEADING.finditer(text))
+    if not headings:
+        return None
+    # The last such heading is the real section, not a mention in the contents
+    start = headings[-1].end()
+    next_section = NEXT_SECTION.search(text, start)
+    end = next_section.start() if next_section else len(text)
+    return start, end
+
+
+def split_entries(section):
+    """Splits a references section into entries: one per labelled or bulleted
+    line (joining wrapped lines), or one per paragraph if nothing is labelled."""
+    lines = [line for line in section.splitlines()]
+    if any(ENTRY_START.match(line) for line in lines):
+        entries = []
+        for line in lines:
+            if ENTRY_START.match(line) or not entries:
+                entries.append(line.strip())
+            elif line.strip():
+                entries[-1] += " " + line.strip()
+        return [entry for entry in entries if entry]
+    return [
+        " ".join(paragraph.split())
+        for paragraph in re.split(r"\n\s*\n", section)
+        if paragraph.strip()
+    ]
+
+
+def surname_of(name):
+    """Returns the surname of an author written as "L. Chizat", "X.-T. Duong",
+    "Chizat L." or "Chizat, L.", or None if the text does not look like a name."""
+    name = name.strip().strip(":").strip()
+    name = re.sub(r"^(?:and|&)\s+", "", name)
+    if INITIALS_FIRST.match(name.rstrip(".")):
+        name = name.rstrip(".")
+        words = name.split()
+    elif INITIALS_LAST.match(name):
+        words = name.replace(",", " ").split()
+    else:
+        return None
+    words = [
+        word
+        for word in words
+        if not re.fullmatch(INITIAL, word) and word.lower() not in NAME_PARTICLES
+    ]
+    return words[-1] if INITIALS_FIRST.match(name) else words[0]
+
+
+def split_authors(rest):
+    """Splits "A. One, B. Two and C. Three, Title, Journal ..." into the
+    surnames of the leading authors and the text that follows them."""
+    spans = []
+    position = 0
+    for separator in AUTHOR_SEPARATOR.finditer(rest):
+        spans.append((position, separator.start()))
+        position = separator.end()
+    spans.append((position, len(rest)))
+    segments = [rest[start:end] for start, end in spans]
+    surnames = []
+    used = 0
+    while used < len(segments):
+        segment = segments[used]
+        surname = surname_of(segment)
+        # "Chizat, L." comes as two segments
+        if (
+            surname == None
+            and used + 1 < len(segments)
+            and re.fullmatch(rf"(?:{INITIAL}\s*)+", segments[used + 1].strip())
+        ):
+            surname = surname_of(segment + " " + segments[used + 1])
+            if surname != None:
+                used += 1
+        if surname == None:
+            break
+        surnames.append(surname)
+        used += 1
+    remainder = rest[spans[used][0] :] if used < len(spans) else ""
+    return surnames, remainder
+
+
+def parse_entry(text):
+    """Parses one reference into its label, surnames, title and year. The
+    entry counts as resolved when it has authors, a title and a year or label."""
+    label = LEADING_LABEL.match(text)
+    rest = text[label.end() :] if label else text
+    rest = rest.strip()
+    # A year in parentheses is the publication year, otherwise take the last one
+    years = PARENTHESIZED_YEAR.findall(rest) or YEAR.findall(rest)
+    year = years[0] if PARENTHESIZED_YEAR.search(rest) else (years[-1] if years else None)
+    apa = APA_ENTRY.match(rest)
+    marked = MARKED_TITLE.search(rest)
+    surnames = []
+    if apa:
+        # "Authors (2020). Title." only if everything before the year is names
+        surnames, remainder = split_authors(apa.group(1))
+        title = apa.group(2)
+        if remainder.strip(" ,.") not in ("", "et al"):
+            surnames = []
+    if surnames:
+        pass
+    elif marked:
+        surnames, _ = split_authors(rest[: marked.start()])
+        title = next(group for group in marked.groups() if group).strip()
+    else:
+        # "A. One, B. Two, Title, Journal" first, then "One A. et al. Title. Journal"
+        surnames, remainder = split_authors(rest)
+        title = re.split(r",\s+|\.\s+", remainder)[0].strip()
+        if not surnames:
+            segments = re.split(r"(?<![A-Z])\.\s+", rest)
+            surnames, _ = split_authors(segments[0])
+            title = segments[1].strip() if len(segments) > 1 else ""
+    return {
+        "text": text.strip(),
+        "label": (label.group(1) or label.group(2)) if label else None,
+        "surnames": surnames,
+        "surname": surnames[0] if surnames else None,
+        "title": title,
+        "year": year[:4] if year else None,
+        "resolved": bool(surnames and title and (year or label)),
+    }
+
+
+def parse_references(text):
+    """Finds and parses the references section of a document. Returns the
+    parsed entries (empty if the document has no recognizable section)."""
+    section = find_references_section(text)
+    if section is None:
+        return []
+    return [parse_entry(entry) for entry in split_entries(text[section[0] : section[1]])]
+
+
+def text_before_references(chunk, entries):
+    """Cuts a chunk at its references heading or at the first entry it holds."""
+    positions = [chunk.find(entry["text"][:40]) for entry in entries]
+    headings = list(REFERENCES_HEADING.finditer(chunk))
+    if headings:
+        positions.append(headings[-1].start())
+    positions = [position for position in positions if position >= 0]
+    return chunk[: min(positions)] if positions else chunk
+
+
+def index_bibliography(list_of_citations):
+    """Parses a list of references with one entry per line (the output of the
+    citation retriever, for example)."""
+    return [parse_entry(line) for line in list_of_citations.splitlines() if line.strip()]
+
+
+def title_key(title):
+    return " ".join(re.findall(r"[a-z0-9]+", (title or "").lower()))
+
+
+def new_entries(lines, known):
+    """The lines (references, one per line) that are not already among the
+    known entries or earlier lines, by label or by title."""
+    labels = {entry["label"] for entry in known if entry["label"]}
+    titles = {title_key(entry["title"]) for entry in known}
+    kept = []
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = parse_entry(line)
+        title = title_key(entry["title"])
+        # Titles too short to tell entries apart are not compared
+        if entry["label"] in labels or (len(title) >= 12 and title in titles):
+            continue
+        kept.append(line)
+        if entry["label"]:
+            labels.add(entry["label"])
+        titles.add(title)
+    return kept
+
+
+class CitationIndex:
+    """Resolves the citation markers of a chunk to bibliography entries."""
+
+    def __init__(self, entries, year_distance=80):
+        self.entries = entries
+        # How far after a surname the year of an author-year citation may be
+        self.year_distance = year_distance
+        self.by_label = {}
+        self.by_surname = {}
+        for entry in entries:
+            if entry["label"]:
+                self.by_label.setdefault(entry["label"], []).append(entry)
+            if entry["surname"]:
+                self.by_surname.setdefault(entry["surname"], []).append(entry)
+        self.matcher = AhoCorasick(self.by_surname.keys())
+        # Entries the LLM retrieved may have lost their numbers
+        self.unlabelled = any(not entry["label"] for entry in entries)
+
+    def is_keyed(self):
+        return bool(self.by_label or self.by_surname)
+
+    def has_unresolved_markers(self, chunk):
+        """Whether the chunk cites [n] labels that no entry carries while some
+        entries have no label, so cited_in may miss what the chunk cites."""
+        return self.unlabelled and any(
+            label not in self.by_label
+            for marker in NUMERIC_MARKER.findall(chunk)
+            for label in expand_marker(marker)
+        )
+
+    def cited_in(self, chunk):
+        cited = {}
+        for marker in NUMERIC_MARKER.findall(chunk):
+            for label in expand_marker(marker):
+                for entry in self.by_label.get(label, []):
+                    cited[id(entry)] = entry
+        for start, surname in self.matcher.find(chunk):
+            window = chunk[start : start + len(surname) + self.year_distance]
+            years = {year[:4] for year in YEAR.findall(window)}
+            for entry in self.by_surname[surname]:
+                if entry["year"] in years:
+                    cited[id(entry)] = entry
+        return list(cited.values())
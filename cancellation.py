@@ -0,0 +1,100 @@
+import contextvars, os, threading, time
+from contextlib import contextmanager
+
+
+### Cooperative cancellation for the tools. A run carries a CancellationToken
+### that can be cancelled from outside (the Cancel button of a job) and can
+### have a deadline. The tool classes hand it to their workflow through the
+### LangGraph config and the current context; the loops over chunks check it
+### between chunks, and the rate limiter while a request waits for its turn
+### or backs off. A stopped run raises RunCancelled and keeps the chunks it
+### finished in the checkpoint journal, so rerunning the tool resumes it.
+###
+### TOOL_TIMEOUT (seconds, unset for none) is the default deadline of a run.
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "0")) or None
+
+
+class RunCancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    def __init__(self, timeout=None, parent=None):
+        self.deadline = None if timeout == None else time.monotonic() + timeout
+        # A run inside a job stops when the job is cancelled, too
+        self.parent = parent
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancel_requested(self):
+        if self.parent != None and self.parent.cancel_requested:
+            return True
+        return self._event.is_set()
+
+    def remaining(self):
+        """Seconds to the nearest deadline, or None without one."""
+        deadlines = []
+        token = self
+        while token != None:
+            if token.deadline != None:
+                deadlines.append(token.deadline - time.monotonic())
+            token = token.parent
+        return max(0.0, min(deadlines)) if deadlines else None
+
+    @property
+    def cancelled(self):
+        return self.cancel_requested or self.remaining() == 0.0
+
+    def check(self):
+        if self.cancel_requested:
+            raise RunCancelled("the run was cancelled")
+        if self.remaining() == 0.0:
+            raise RunCancelled("the run went past its deadline")
+
+    def wait(self, seconds):
+        """Sleeps up to `seconds`, waking early on cancellation. Returns True if
+        the run has been cancelled."""
+        remaining = self.remaining()
+        if remaining != None:
+            seconds = min(seconds, remaining)
+        # The event of a parent is not ours to wait on, so wake up now and then
+        end = time.monotonic() + seconds
+        while not self.cancelled:
+            left = end - time.monotonic()
+            if left <= 0:
+                break
+            self._event.wait(min(left, 0.5))
+        return self.cancelled
+
+
+current_token = contextvars.ContextVar("cancellation_token", default=None)
+
+
+@contextmanager
+def cancellation_scope(token):
+    """Makes the token the current one for the code inside the block."""
+    reset = current_token.set(token)
+    try:
+        yield token
+    finally:
+        current_token.reset(reset)
+
+
+def get_token(config=None):
+    """The token of the run: the one in the LangGraph config of the node, if
+    any, otherwise the current one (None outside of a run)."""
+    if config != None:
+        token = config.get("configurable", {}).get("cancellation_token")
+        if token != None:
+            return token
+    return current_token.get()
+
+
+def check_cancelled(config=None):
+    """Raises RunCancelled if the run has been cancelled or is out of time."""
+    token = get_token(config)
+    if token != None:
+        token.check()
@@ -0,0 +1,79 @@
+import hashlib, json, os, sqlite3, threading, time
+from langchain_core.load import dumps, loads
+
+
+### Journal of the chunks a workflow has already finished. A run is keyed by
+### the workflow step and a hash of all its inputs (the chunks of the file and
+### the parameters that go with them: language, auxilary text, ...), and every
+### result is written as soon as its chunk is done. Rerunning the same tool on
+### the same file resumes from the chunks that are still missing. The entries
+### of a run are dropped once its output file has been written.
+class ChunkJournal:
+    def __init__(
+        self, database_path="files/cache/checkpoints.sqlite", max_age_days=14
+    ):
+        self.database_path = database_path
+        self.max_age = max_age_days * 24 * 60 * 60
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(database_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS chunks (
+                run TEXT NOT NULL,
+                chunk INTEGER NOT NULL,
+                result TEXT NOT NULL,
+                saved REAL NOT NULL,
+                PRIMARY KEY (run, chunk)
+            )"""
+        )
+        # Runs that were abandoned long ago are not worth resuming
+        self._connection.execute(
+            "DELETE FROM chunks WHERE saved < ?", (time.time() - self.max_age,)
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def run_key(step, inputs):
+        digest = hashlib.sha256(step.encode("utf-8"))
+        digest.update(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    def checkpoint(self, step, inputs):
+        return Checkpoint(self, self.run_key(step, inputs))
+
+    def completed(self, run):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT chunk, result FROM chunks WHERE run = ?", (run,)
+            ).fetchall()
+        return {chunk: loads(result) for chunk, result in rows}
+
+    def save(self, run, chunk, result):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)",
+                (run, chunk, dumps(result), time.time()),
+            )
+            self._connection.commit()
+
+    def finish(self, run):
+        with self._lock:
+            self._connection.execute("DELETE FROM chunks WHERE run = ?", (run,))
+            self._connection.commit()
+
+
+class Checkpoint:
+    """The journal entries of one run, as handed to run_chunks."""
+
+    def __init__(self, journal, run):
+        self.journal = journal
+        self.run = run
+
+    def completed(self):
+        return self.journal.completed(self.run)
+
+    def save(self, chunk, result):
+        self.journal.save(self.run, chunk, result)
+
+    def finish(self):
+        self.journal.finish(self.run)
@@ -0,0 +1,103 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from tqdm import tqdm
+from progress import report_progress
+from cancellation import RunCancelled, current_token
+
+# How often a run with a cancellation token looks at it while requests are out
+CANCEL_POLL_SECONDS = 0.5
+
+
+### Helpers that push a list of independent chunk inputs through a
+### prompt | model chain. The chunks are sent with a bounded number of
+### requests in flight and the results come back in the original order.
+def iter_chunks(chain, inputs, max_concurrency=1, checkpoint=None, token=None):
+    """Invokes the chain on every input, keeping at most max_concurrency
+    requests in flight, and yields the results in the order of the inputs as
+    soon as each one and all before it are done. With a checkpoint, the
+    chunks it already holds are not sent again and every new result is saved
+    to it as soon as it arrives. The token (the current one by default) is
+    checked between chunks; a cancelled run raises RunCancelled."""
+    if token == None:
+        token = current_token.get()
+    max_concurrency = max(1, max_concurrency)
+    results = [None] * len(inputs)
+    todo = list(range(len(inputs)))
+    if checkpoint != None:
+        for index, result in checkpoint.completed().items():
+            if index < len(inputs):
+                results[index] = result
+        todo = [index for index in todo if results[index] is None]
+        if len(todo) < len(inputs):
+            print(f"Resuming: {len(inputs) - len(todo)} of {len(inputs)} chunks done")
+    next_to_yield = 0
+    # Shut down by hand: a cancelled run must not wait for its requests
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    cancelled = False
+    progress = tqdm(total=len(inputs), initial=len(inputs) - len(todo))
+    pending = {}
+    next_index = 0
+    try:
+        report_progress(len(inputs) - len(todo), len(inputs))
+        while next_index < len(todo) or pending:
+            if token != None:
+                token.check()
+            # Keep the pool topped up without queueing the whole document at once
+            while next_index < len(todo) and len(pending) < max_concurrency:
+                index = todo[next_index]
+                # The request sees the token too, for the rate limiter
+                context = contextvars.copy_context()
+                future = executor.submit(context.run, chain.invoke, inputs[index])
+                pending[future] = index
+                next_index += 1
+            while next_to_yield < len(inputs) and results[next_to_yield] is not None:
+                yield results[next_to_yield]
+                next_to_yield += 1
+            done, _ = wait(
+                pending,
+                timeout=None if token == None else CANCEL_POLL_SECONDS,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                index = pending.pop(future)
+                results[index] = future.result()
+                if checkpoint != None:
+                    checkpoint.save(index, results[index])
+                progress.update(1)
+            report_progress(progress.n, len(inputs))
+    except RunCancelled:
+        # The requests that have not started are dropped; the ones on the wire
+        # are not waited for, but still save their result when they are back
+        cancelled = True
+        for future, index in pending.items():
+            if not future.cancel() and checkpoint != None:
+                future.add_done_callback(save_when_done(checkpoint, index))
+        raise
+    except BaseException:
+        # A failed chunk, Ctrl-C or a caller that stopped reading: keep
+        # whatever the requests still in flight bring back, so the next
+        # run does not pay for them again
+        if checkpoint != None:
+            for future in wait(pending).done:
+                if not future.cancelled() and future.exception() is None:
+                    checkpoint.save(pending[future], future.result())
+        raise
+    finally:
+        progress.close()
+        executor.shutdown(wait=not cancelled)
+    while next_to_yield < len(inputs):
+        yield results[next_to_yield]
+        next_to_yield += 1
+
+
+def save_when_done(checkpoint, index):
+    def save(future):
+        if not future.cancelled() and future.exception() is None:
+            checkpoint.save(index, future.result())
+
+    return save
+
+
+def run_chunks(chain, inputs, max_concurrency=1, checkpoint=None, token=None):
+    """Like iter_chunks, but returns all the results as a list."""
+    return list(iter_chunks(chain, inputs, max_concurrency, checkpoint, token))
@@ -0,0 +1,162 @@
+import hashlib, os, urllib.request
+
+
+### Resumable downloads of PDFs. The bytes go to a .part file in
+### files/cache/downloads (so the pdfs folder never lists half a paper), an
+### interrupted download resumes with an HTTP Range request guarded by
+### If-Range, and the file only takes its final name once its size and its
+### %PDF- header check out. Nothing is fetched when the saved file matches the
+### remote ETag, or its size if the server sends no ETag.
+###
+### stream_download is the blocking version (urllib) used by download_pdf;
+### astream_download does the same over an httpx.AsyncClient for the batch
+### arXiv retriever.
+DOWNLOAD_STATE_FOLDER = os.path.join("files", "cache", "downloads")
+
+
+class DownloadState:
+    """Where the partial file and the ETags of a download are kept, and the
+    decisions that only depend on them."""
+
+    def __init__(self, save_path, state_folder=DOWNLOAD_STATE_FOLDER):
+        os.makedirs(state_folder, exist_ok=True)
+        key = hashlib.sha256(os.path.abspath(save_path).encode("utf-8")).hexdigest()
+        self.save_path = save_path
+        self.part_path = os.path.join(state_folder, f"{key}.part")
+        self.etag_path = os.path.join(state_folder, f"{key}.etag")
+        self.part_etag_path = os.path.join(state_folder, f"{key}.part.etag")
+
+    def unchanged(self, etag, size):
+        """Whether the saved file is the remote one already."""
+        if not os.path.exists(self.save_path):
+            return False
+        stored_etag = read_text_if_exists(self.etag_path)
+        if etag and stored_etag:
+            return etag == stored_etag
+        return size >= 0 and os.path.getsize(self.save_path) == size
+
+    def start(self, etag):
+        """Returns the offset to resume from. A partial file is only continued
+        if it belongs to the same remote version."""
+        offset = 0
+        if os.path.exists(self.part_path) and etag == (
+            read_text_if_exists(self.part_etag_path) or None
+        ):
+            offset = os.path.getsize(self.part_path)
+        with open(self.part_etag_path, "w", encoding="utf-8") as f:
+            f.write(etag or "")
+        return offset
+
+    def restart(self):
+        # The server cannot continue from our offset (416)
+        os.remove(self.part_path)
+
+    def finish(self, url, size, expected_header):
+        """Checks the partial file and moves it into place."""
+        with open(self.part_path, "rb") as file:
+            header = file.read(len(expected_header))
+        if (
+            size >= 0 and os.path.getsize(self.part_path) != size
+        ) or header != expected_header:
+            os.remove(self.part_path)
+            raise IOError(f"The download of {url} is incomplete or corrupted")
+        os.replace(self.part_path, self.save_path)
+        os.replace(self.part_etag_path, self.etag_path)
+        return "downloaded"
+
+
+def range_headers(offset, etag):
+    headers = {}
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+        if etag:
+            headers["If-Range"] = etag
+    return headers
+
+
+def stream_download(
+    url,
+    save_path,
+    chunk_size=1 << 16,
+    expected_header=b"%PDF-",
+    state_folder=DOWNLOAD_STATE_FOLDER,
+):
+    """Downloads url to save_path in fixed-size chunks, resuming an
+    interrupted download. Returns "unchanged" or "downloaded"."""
+    state = DownloadState(save_path, state_folder)
+    with urllib.request.urlopen(urllib.request.Request(url, method="HEAD")) as response:
+        etag = response.headers.get("ETag")
+        size = int(response.headers.get("Content-Length") or -1)
+    if state.unchanged(etag, size):
+        return "unchanged"
+    offset = state.start(etag)
+    # A partial file that already has every byte only needs checking
+    if size < 0 or offset < size:
+        try:
+            fetch_into(url, state.part_path, offset, etag, chunk_size)
+        except urllib.error.HTTPError as e:
+            if e.code != 416 or offset == 0:
+                raise
+            state.restart()
+            fetch_into(url, state.part_path, 0, etag, chunk_size)
+    return state.finish(url, size, expected_header)
+
+
+def fetch_into(url, part_path, offset, etag, chunk_size):
+    """Writes the remote file from offset on to the end of part_path."""
+    request = urllib.request.Request(url, headers=range_headers(offset, etag))
+    with urllib.request.urlopen(request) as response:
+        # 200 instead of 206 means the server sends the whole file again
+        mode = "ab" if response.status == 206 else "wb"
+        with open(part_path, mode) as file:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                file.write(chunk)
+
+
+async def astream_download(
+    client,
+    url,
+    save_path,
+    expected_header=b"%PDF-",
+    state_folder=DOWNLOAD_STATE_FOLDER,
+):
+    """stream_download over an httpx.AsyncClient."""
+    import httpx
+
+    state = DownloadState(save_path, state_folder)
+    response = await client.head(url)
+    response.raise_for_status()
+    etag = response.headers.get("ETag")
+    size = int(response.headers.get("Content-Length") or -1)
+    if state.unchanged(etag, size):
+        return "unchanged"
+    offset = state.start(etag)
+    if size < 0 or offset < size:
+        try:
+            await afetch_into(client, url, state.part_path, offset, etag)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 416 or offset == 0:
+                raise
+            state.restart()
+            await afetch_into(client, url, state.part_path, 0, etag)
+    return state.finish(url, size, expected_header)
+
+
+async def afetch_into(client, url, part_path, offset, etag):
+    headers = range_headers(offset, etag)
+    async with client.stream("GET", url, headers=headers) as response:
+        response.raise_for_status()
+        mode = "ab" if response.status_code == 206 else "wb"
+        with open(part_path, mode) as file:
+            async for chunk in response.aiter_bytes():
+                file.write(chunk)
+
+
+def read_text_if_exists(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
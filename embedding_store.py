@@ -0,0 +1,122 @@
+import hashlib, json, os, threading
+import numpy as np
+
+
+### Local store for the embeddings of text chunks. Every embedder model gets
+### its own folder with a float32 matrix (vectors.f32, read through a memory
+### map) and a sidecar index.json that maps the hash of a chunk to its row.
+### Only the chunks that are not in the store are sent to the embedder.
+###
+### Several stores may share a folder (the OCR enhancer and the library index
+### each make their own), so the lock belongs to the folder, not to the store.
+_directory_locks = {}
+_directory_locks_lock = threading.Lock()
+
+
+def directory_lock(directory):
+    """The lock shared by every store of the directory in this process."""
+    with _directory_locks_lock:
+        return _directory_locks.setdefault(
+            os.path.abspath(directory), threading.Lock()
+        )
+
+
+class EmbeddingStore:
+    def __init__(self, directory="files/cache/embeddings"):
+        self.directory = directory
+        self._lock = directory_lock(directory)
+
+    @staticmethod
+    def model_name(embedder):
+        return str(getattr(embedder, "model", type(embedder).__name__))
+
+    @staticmethod
+    def chunk_key(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _paths(self, model):
+        folder = os.path.join(
+            self.directory, hashlib.sha256(model.encode("utf-8")).hexdigest()[:16]
+        )
+        return (
+            folder,
+            os.path.join(folder, "vectors.f32"),
+            os.path.join(folder, "index.json"),
+        )
+
+    def _load_index(self, model):
+        _, _, index_path = self._paths(model)
+        if not os.path.exists(index_path):
+            return {"model": model, "dim": None, "rows": {}}
+        with open(index_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _vectors(self, model, index):
+        _, vectors_path, _ = self._paths(model)
+        if not index["rows"]:
+            return np.zeros((0, index["dim"] or 0), dtype=np.float32)
+        return np.memmap(
+            vectors_path,
+            dtype=np.float32,
+            mode="r",
+            shape=(len(index["rows"]), index["dim"]),
+        )
+
+    def _append(self, model, index, keys, vectors):
+        folder, vectors_path, index_path = self._paths(model)
+        os.makedirs(folder, exist_ok=True)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if index["dim"] is None:
+            index["dim"] = int(vectors.shape[1])
+        # The rows are written before the index, so a crash in between only
+        # leaves unreferenced rows at the end of the file.
+        with open(vectors_path, "r+b" if os.path.exists(vectors_path) else "wb") as f:
+            f.seek(len(index["rows"]) * index["dim"] * 4)
+            f.write(vectors.tobytes())
+            f.truncate()
+        for key in keys:
+            index["rows"][key] = len(index["rows"])
+        temp_path = index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(temp_path, index_path)
+
+    def embed_documents(self, embedder, texts):
+        """Returns a float32 array with one row per text, calling the embedder
+        only for the texts it has not seen before."""
+        model = self.model_name(embedder)
+        keys = [self.chunk_key(text) for text in texts]
+        with self._lock:
+            index = self._load_index(model)
+            missing = {}
+            for key, text in zip(keys, texts):
+                if key not in index["rows"] and key not in missing:
+                    missing[key] = text
+            if missing:
+                print(
+                    f"Embedding {len(missing)} new chunks, {len(set(keys)) - len(missing)} found in the store"
+                )
+                new_vectors = embedder.embed_documents(list(missing.values()))
+                self._append(model, index, list(missing.keys()), new_vectors)
+            vectors = self._vectors(model, index)
+            rows = [index["rows"][key] for key in keys]
+            return np.array(vectors[rows], dtype=np.float32)
+
+    def embed_long_documents(self, embedder, texts, window_chars):
+        """Like embed_documents for texts longer than the embedder takes in:
+        every text is cut into windows of window_chars characters, which are
+        embedded (and stored) on their own, and gets the mean of their unit
+        vectors."""
+        windows = []
+        owners = []
+        for i, text in enumerate(texts):
+            for start in range(0, max(len(text), 1), window_chars):
+                windows.append(text[start : start + window_chars])
+                owners.append(i)
+        vectors = self.embed_documents(embedder, windows)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+        result = np.zeros((len(texts), vectors.shape[1]), dtype=np.float32)
+        np.add.at(result, owners, vectors)
+        counts = np.bincount(owners, minlength=len(texts))
+        return result / counts[:, None]
@@ -0,0 +1,119 @@
+import contextvars, itertools, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from output_writer import partial_output
+from progress import progress_listener
+from cancellation import CancellationToken, RunCancelled, cancellation_scope
+
+
+### Background jobs for the Streamlit app. A tool call becomes a job that runs
+### in a shared pool of worker threads, so the page stays responsive, several
+### users (and several jobs per user) run side by side, and a long translation
+### does not freeze the session that started it. Every job records its status,
+### how many chunks are done and the file it writes, so the app can poll it
+### and show the partial output while it grows.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Finished jobs are forgotten after a day
+JOB_MAX_AGE = 24 * 60 * 60
+
+
+class Job:
+    def __init__(self, job_id, name, args, owner=None):
+        self.id = job_id
+        self.name = name
+        self.args = args
+        self.owner = owner
+        self.status = "queued"
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.output_path = None
+        self.created = time.time()
+        self.finished = None
+        # The tool checks it between chunks
+        self.token = CancellationToken()
+
+    def progress(self, done, total):
+        self.done = done
+        self.total = total
+
+    def output(self, path):
+        self.output_path = path
+
+    @property
+    def cancel_requested(self):
+        return self.token.cancel_requested
+
+    @property
+    def finished_running(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def partial_output(self):
+        if self.output_path == None:
+            return None
+        return partial_output(self.output_path)
+
+
+class JobManager:
+    def __init__(self, max_workers=JOB_WORKERS):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, name, function, args, owner=None):
+        """Queues function(args) as a job and returns the Job right away."""
+        with self._lock:
+            self._forget_old_jobs()
+            job = Job(next(self._ids), name, args, owner)
+            self._jobs[job.id] = job
+        # A fresh context per job, so the listener does not leak into the next
+        # job that runs on the same worker thread
+        self._executor.submit(contextvars.Context().run, self._run, job, function)
+        return job
+
+    def _run(self, job, function):
+        if job.cancel_requested:
+            job.status = "cancelled"
+            job.finished = time.time()
+            return
+        progress_listener.set(job)
+        job.status = "running"
+        try:
+            with cancellation_scope(job.token):
+                job.result = function(job.args)
+            # The tools report a stopped run instead of raising
+            job.status = "cancelled" if job.cancel_requested else "done"
+        except RunCancelled as e:
+            job.error = str(e)
+            job.status = "cancelled"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        job.finished = time.time()
+
+    def cancel(self, job_id):
+        """Asks the job to stop. A queued job never starts; a running one stops
+        at its next chunk, keeping the chunks it has finished."""
+        job = self.get(job_id)
+        if job == None or job.finished_running:
+            return False
+        job.token.cancel()
+        return True
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self, owner=None):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job for job in jobs if owner == None or job.owner == owner]
+
+    def _forget_old_jobs(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished != None and now - job.finished > JOB_MAX_AGE:
+                del self._jobs[job_id]
@@ -0,0 +1,137 @@
+import hashlib, os, sqlite3, threading, time
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+
+### Persistent cache for the responses of the chat models. LangChain consults
+### it inside every prompt_template | model chain, with the rendered prompt and
+### a string describing the model (name, temperature, ...). Identical requests
+### are therefore answered from disk instead of being sent to the API again.
+###
+### Only the models of the workflows that transform a file chunk by chunk use
+### it (get_chat_model(cached=True)); the supervisor and the arXiv agent loop
+### repeat prompts while the folders change, and must not replay old answers.
+class LLMResponseCache(BaseCache):
+    def __init__(
+        self,
+        database_path="files/cache/llm_cache.sqlite",
+        max_size_mb=500,
+        max_age_days=30,
+        eviction_interval=100,
+    ):
+        self.database_path = database_path
+        self.max_size = max_size_mb * 1024 * 1024
+        self.max_age = max_age_days * 24 * 60 * 60
+        # Eviction runs after this many writes, not on every single one
+        self.eviction_interval = eviction_interval
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(database_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(prompt, llm_string):
+        return hashlib.sha256(
+            (llm_string + "\0" + prompt).encode("utf-8")
+        ).hexdigest()
+
+    def lookup(self, prompt, llm_string):
+        key = self.make_key(prompt, llm_string)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or time.time() - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._connection.commit()
+            self.hits += 1
+        return loads(row[0])
+
+    def update(self, prompt, llm_string, return_val):
+        key = self.make_key(prompt, llm_string)
+        response = dumps(list(return_val))
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response), now, now),
+            )
+            self._connection.commit()
+            self._writes += 1
+            should_evict = self._writes % self.eviction_interval == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        """Drops the entries older than max_age_days and then the least recently
+        used ones until the cache fits in max_size_mb."""
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,)
+            )
+            total = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+            if total > self.max_size:
+                rows = self._connection.execute(
+                    "SELECT key, size FROM responses ORDER BY last_used"
+                ).fetchall()
+                stale = []
+                for key, size in rows:
+                    if total <= self.max_size:
+                        break
+                    stale.append((key,))
+                    total -= size
+                self._connection.executemany(
+                    "DELETE FROM responses WHERE key = ?", stale
+                )
+            self._connection.commit()
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "size_mb": round(size / (1024 * 1024), 2),
+        }
+
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """The cache of the workflow models, opened on first use."""
+    global response_cache
+    with response_cache_lock:
+        if response_cache == None:
+            response_cache = LLMResponseCache()
+        return response_cache
@@ -4,7 +4,7 @@ from langchain_core.messages import BaseMessage, ToolMessage, AIMessage
 from langgraph.prebuilt import ToolInvocation
 from langgraph.prebuilt.tool_executor import ToolExecutor
 from typing import TypedDict, Annotated
-from langchain_google_genai import ChatGoogleGenerativeAI
+from model_pool import get_chat_model
 from prompts import *
 from simple_tools import *
 from workflows_as_tools import *
@@ -80,7 +80,7 @@ class MetaWorkflow:
         return workflow
 
 
-model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+model = get_chat_model()
 workflow = MetaWorkflow(model)
 app = workflow.create_workflow()
 app = app.compile()
@@ -0,0 +1,43 @@
+import threading
+
+
+### One client per model and settings for the whole process. The workflows and
+### tools used to build their own ChatGoogleGenerativeAI each (a dozen of them
+### in create_tools alone), every one with its own gRPC channel. The clients
+### keep no state between calls, so they can be shared by every chain.
+###
+### The Google SDK is imported with the first client, not with this module, so
+### the CLI and the Streamlit app start without paying for it.
+DEFAULT_CHAT_MODEL = "gemini-1.5-flash"
+DEFAULT_EMBEDDING_MODEL = "models/text-embedding-004"
+pool = {}
+pool_lock = threading.Lock()
+
+
+def _pooled(kind, factory, model, settings):
+    key = (kind, model, repr(sorted(settings.items())))
+    with pool_lock:
+        if key not in pool:
+            pool[key] = factory(model=model, **settings)
+        return pool[key]
+
+
+def get_chat_model(model=DEFAULT_CHAT_MODEL, cached=False, **settings):
+    """The shared chat client for the model and settings (temperature etc). A
+    cached client answers a prompt it has seen from the response cache."""
+    from rate_limiting import RateLimitedChatGoogleGenerativeAI
+
+    if not cached:
+        return _pooled("chat", RateLimitedChatGoogleGenerativeAI, model, settings)
+    from llm_cache import get_response_cache
+
+    def cached_client(**kwargs):
+        return RateLimitedChatGoogleGenerativeAI(cache=get_response_cache(), **kwargs)
+
+    return _pooled("cached chat", cached_client, model, settings)
+
+
+def get_embeddings(model=DEFAULT_EMBEDDING_MODEL, **settings):
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    return _pooled("embeddings", GoogleGenerativeAIEmbeddings, model, settings)
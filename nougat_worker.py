@@ -0,0 +1,315 @@
+import json, os, queue, secrets, threading, time
+from multiprocessing.connection import Listener, Client
+
+
+### Long-lived Nougat worker. The nougat CLI imports torch and loads the model
+### weights for every conversion, which costs more than the pages themselves
+### for a short paper. `python nougat_worker.py` loads the model once and
+### takes conversion jobs (a PDF and its page numbers) over a local socket.
+### The pages of all the queued jobs go into the same batches, and every page
+### is sent back to its client as soon as it is transcribed. When a batch
+### fails, its pages are tried again one by one, so only the job whose page
+### breaks the model gets the error.
+###
+### pdf_conversion sends its Nougat pages here when the worker is running and
+### falls back to the CLI when it is not.
+###
+### Only processes of the same user may talk to the worker: it makes up a
+### random key at startup (unless NOUGAT_WORKER_AUTHKEY is set) and writes it
+### to a file only the user can read, and the messages are plain JSON, so a
+### client can never make the worker run code of its own.
+NOUGAT_WORKER_ADDRESS = ("localhost", int(os.getenv("NOUGAT_WORKER_PORT", "6010")))
+NOUGAT_WORKER_KEY_FILE = os.path.join("files", "cache", "nougat_worker.key")
+NOUGAT_BATCH_SIZE = int(os.getenv("NOUGAT_BATCH_SIZE", "4"))
+# Seconds a client waits for its next page before it gives the worker up
+NOUGAT_STALL_TIMEOUT = float(os.getenv("NOUGAT_STALL_TIMEOUT", "300"))
+# Resolution Nougat's own dataset renders the pages at
+NOUGAT_DPI = 96
+
+
+class NougatWorkerError(RuntimeError):
+    pass
+
+
+def worker_authkey(key_file=NOUGAT_WORKER_KEY_FILE):
+    """The key of a starting worker, written where its clients find it."""
+    key = os.getenv("NOUGAT_WORKER_AUTHKEY") or secrets.token_hex(32)
+    os.makedirs(os.path.dirname(key_file) or ".", exist_ok=True)
+    descriptor = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # The mode of open only applies to a new file
+    os.chmod(key_file, 0o600)
+    with os.fdopen(descriptor, "w") as f:
+        f.write(key)
+    return key.encode()
+
+
+def client_authkey(key_file=NOUGAT_WORKER_KEY_FILE):
+    """The key of the running worker. Without a key file there is no worker,
+    which the caller sees as a refused connection."""
+    key = os.getenv("NOUGAT_WORKER_AUTHKEY")
+    if key:
+        return key.encode()
+    try:
+        with open(key_file, "r") as f:
+            return f.read().strip().encode()
+    except FileNotFoundError:
+        raise ConnectionRefusedError("the nougat worker is not running")
+
+
+def send_message(connection, message):
+    connection.send_bytes(json.dumps(message).encode("utf-8"))
+
+
+def receive_message(connection):
+    return json.loads(connection.recv_bytes().decode("utf-8"))
+
+
+class Job:
+    """One connected client and its pages; the worker side of NougatJob."""
+
+    def __init__(self, connection, pdf_path, pages):
+        self.connection = connection
+        self.pdf_path = pdf_path
+        self.remaining = len(pages)
+        self.failed = False
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            if self.failed:
+                return
+            try:
+                send_message(self.connection, message)
+            except OSError:
+                # The client is gone (Ctrl-C, crash): drop the rest of its pages
+                self.failed = True
+
+    def page_done(self, page, text):
+        self.send(("page", page, text))
+        with self._lock:
+            self.remaining -= 1
+            finished = self.remaining == 0
+        if finished:
+            self.send(("done",))
+            self.connection.close()
+
+    def fail(self, error):
+        self.send(("error", str(error)))
+        self.failed = True
+        self.connection.close()
+
+
+class NougatWorker:
+    def __init__(
+        self,
+        address=NOUGAT_WORKER_ADDRESS,
+        authkey=None,
+        batch_size=NOUGAT_BATCH_SIZE,
+        model_tag=None,
+    ):
+        self.address = address
+        self.authkey = authkey
+        self.batch_size = batch_size
+        self.model_tag = model_tag
+        # Bounded, so the rendered pages of a long PDF wait on disk, not in memory
+        self.pages = queue.Queue(maxsize=4 * batch_size)
+        self.model = None
+
+    def load_model(self):
+        import torch
+        from nougat import NougatModel
+        from nougat.utils.checkpoint import get_checkpoint
+        from nougat.utils.device import move_to_device
+        from pdf_conversion import NOUGAT_MODEL
+
+        checkpoint = get_checkpoint(None, model_tag=self.model_tag or NOUGAT_MODEL)
+        model = NougatModel.from_pretrained(checkpoint)
+        cuda = torch.cuda.is_available()
+        self.model = move_to_device(model, bf16=cuda, cuda=cuda)
+        self.model.eval()
+
+    def queue_job(self, connection):
+        """Reads one job from the connection and queues its pages, rendered
+        one at a time as the batches make room for them."""
+        import pymupdf
+        from PIL import Image
+
+        try:
+            pdf_path, pages = receive_message(connection)
+            if not isinstance(pdf_path, str) or not all(
+                isinstance(page, int) for page in pages
+            ):
+                raise ValueError("expected a path and a list of page numbers")
+        except (EOFError, OSError):
+            return
+        except (ValueError, TypeError) as e:
+            # Not a job; tell the client and drop it
+            send_message(connection, ("error", f"bad job: {e}"))
+            connection.close()
+            return
+        job = Job(connection, pdf_path, pages)
+        if not pages:
+            job.send(("done",))
+            connection.close()
+            return
+        try:
+            with pymupdf.open(pdf_path) as document:
+                for page in pages:
+                    if job.failed:
+                        return
+                    pixmap = document[page].get_pixmap(dpi=NOUGAT_DPI)
+                    image = Image.frombytes(
+                        "RGB", [pixmap.width, pixmap.height], pixmap.samples
+                    )
+                    tensor = self.model.encoder.prepare_input(
+                        image, random_padding=False
+                    )
+                    self.pages.put((job, page, tensor))
+        except Exception as e:
+            job.fail(e)
+
+    def next_batch(self):
+        """Waits for one page, then takes whatever else is queued, from any
+        job, up to the batch size."""
+        batch = [self.pages.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.pages.get(timeout=0.05))
+            except queue.Empty:
+                break
+        return [item for item in batch if not item[0].failed]
+
+    def transcribe(self, batch):
+        """Runs the pages through the model and sends each to its job. Nothing
+        is sent unless the whole batch went through."""
+        import torch
+        from nougat.postprocessing import markdown_compatible
+
+        with torch.no_grad():
+            output = self.model.inference(
+                image_tensors=torch.stack([tensor for _, _, tensor in batch]),
+                early_stopping=False,
+            )
+        texts = [
+            markdown_compatible(prediction) for prediction in output["predictions"]
+        ]
+        for (job, page, _), text in zip(batch, texts):
+            job.page_done(page, text)
+
+    def run_batches(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            try:
+                self.transcribe(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][0].fail(e)
+                    continue
+                # Find the page that broke the batch, so only its job fails
+                print(f"A batch failed ({e}), retrying its pages one by one")
+                for item in batch:
+                    if item[0].failed:
+                        continue
+                    try:
+                        self.transcribe([item])
+                    except Exception as e:
+                        item[0].fail(e)
+            print(f"Transcribed {len(batch)} pages, {self.pages.qsize()} queued")
+
+    def serve(self):
+        print("Loading the Nougat model...")
+        self.load_model()
+        threading.Thread(target=self.run_batches, daemon=True).start()
+        if self.authkey == None:
+            self.authkey = worker_authkey()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"Nougat worker listening on {self.address[0]}:{self.address[1]}")
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:
+                    # A client with the wrong key, or one that hung up at once
+                    print(f"Rejected a connection: {e}")
+                    continue
+                threading.Thread(
+                    target=self.queue_job, args=(connection,), daemon=True
+                ).start()
+
+
+class NougatJob:
+    """Sends the pages of a PDF to a running worker and collects the answers
+    in the background. Raises ConnectionRefusedError if no worker runs."""
+
+    def __init__(
+        self,
+        pdf_path,
+        pages,
+        address=NOUGAT_WORKER_ADDRESS,
+        authkey=None,
+    ):
+        self.pages = pages
+        self.texts = {}
+        self.error = None
+        self.last_message = time.monotonic()
+        if authkey == None:
+            authkey = client_authkey()
+        self._connection = Client(address, authkey=authkey)
+        send_message(self._connection, (os.path.abspath(pdf_path), list(pages)))
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+
+    def _receive(self):
+        from tqdm import tqdm
+
+        try:
+            with tqdm(total=len(self.pages), desc="nougat") as progress:
+                while True:
+                    message = receive_message(self._connection)
+                    self.last_message = time.monotonic()
+                    if message[0] == "page":
+                        self.texts[message[1]] = message[2]
+                        progress.update(1)
+                    elif message[0] == "error":
+                        self.error = message[1]
+                        return
+                    else:
+                        return
+        except (EOFError, OSError) as e:
+            self.error = f"lost the connection to the worker: {e}"
+        finally:
+            self._connection.close()
+
+    def wait(self, stall_timeout=NOUGAT_STALL_TIMEOUT, token=None):
+        """Returns {page: markdown}; raises NougatWorkerError if the job failed
+        or no page came for stall_timeout seconds, and RunCancelled if the run
+        (the token, or the current one) is cancelled meanwhile."""
+        from cancellation import get_token
+
+        if token == None:
+            token = get_token()
+        while self._thread.is_alive():
+            if token != None and token.cancelled:
+                self.cancel()
+                token.check()
+            if time.monotonic() - self.last_message > stall_timeout:
+                self.cancel()
+                raise NougatWorkerError(
+                    f"no answer from the worker for {stall_timeout:.0f}s"
+                )
+            self._thread.join(0.5)
+        if self.error != None:
+            raise NougatWorkerError(self.error)
+        return self.texts
+
+    def cancel(self):
+        self._connection.close()
+
+
+def main():
+    NougatWorker().serve()
+
+
+if __name__ == "__main__":
+    main()
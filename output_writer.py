@@ -0,0 +1,65 @@
+import os
+from progress import report_output
+
+
+### Append-only writer for the output files of the workflows. Every finished
+### chunk is flushed to {path}.part right away, and the file only takes its
+### final name, atomically, once the last chunk is in. Until then the .part
+### file is a usable partial result, and a failed run leaves it behind.
+class StreamingWriter:
+    def __init__(self, path, separator=""):
+        self.path = path
+        self.part_path = path + ".part"
+        self.separator = separator
+        self.chunks = 0
+        self._file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.part_path, "w", encoding="utf-8")
+        report_output(self.path)
+        return self
+
+    def write(self, text):
+        if self.chunks:
+            self._file.write(self.separator)
+        self._file.write(text)
+        self._file.flush()
+        self.chunks += 1
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            os.replace(self.part_path, self.path)
+        else:
+            self._file.close()
+        return False
+
+
+def stream_to_file(path, pieces, separator=""):
+    """Writes the pieces to path as they come and yields each one after it is
+    on disk, so the caller can show the output while it is produced."""
+    with StreamingWriter(path, separator) as writer:
+        for piece in pieces:
+            writer.write(piece)
+            yield piece
+
+
+def write_chunks(path, pieces, separator=""):
+    """Writes the pieces to path as they come; returns the number of pieces."""
+    count = 0
+    for _ in stream_to_file(path, pieces, separator):
+        count += 1
+    return count
+
+
+def partial_output(path):
+    """What has been written to path so far: the partial file while a run is
+    writing it, otherwise the finished file, or None."""
+    for candidate in (path + ".part", path):
+        if os.path.exists(candidate):
+            with open(candidate, "r", encoding="utf-8") as f:
+                return f.read()
+    return None
@@ -0,0 +1,249 @@
+import hashlib, json, os, subprocess, tempfile
+from concurrent.futures import ProcessPoolExecutor
+from importlib.metadata import version
+
+
+### Conversion engine behind the pdf_to_markdown tool. The PDF is split into
+### pages; MuPDF extracts page ranges in a process pool while Nougat runs
+### concurrently over shards of single-page PDFs in its own worker processes.
+### The per-page outputs are stitched back into {name}.mmd and mu_{name}.mmd.
+###
+### Every converted page is also kept in files/page_cache, keyed by a hash of
+### the page content and the engine version, so re-converting a revised PDF
+### only sends the new or changed pages through the engines.
+###
+### Nougat pages go to a running nougat_worker (model already loaded) when
+### there is one; otherwise the nougat CLI is started as before.
+###
+### Next to every markdown, files/pages/{name}.json records the byte range of
+### each PDF page in it, so search results can point at their page.
+PDF_FOLDER = os.path.join("files", "pdfs")
+MARKDOWN_FOLDER = os.path.join("files", "markdowns")
+PAGE_CACHE_FOLDER = os.path.join("files", "page_cache")
+PAGES_FOLDER = os.path.join("files", "pages")
+NOUGAT_MODEL = "0.1.0-base"
+# Nougat loads its model once per worker, so more than one only pays off with
+# enough GPU memory (or CPU cores) to hold several copies.
+NOUGAT_WORKERS = int(os.getenv("NOUGAT_WORKERS", "1"))
+MUPDF_WORKERS = int(os.getenv("MUPDF_WORKERS", str(os.cpu_count() or 1)))
+
+
+def engine_versions():
+    return {
+        "nougat": f"nougat-{NOUGAT_MODEL}",
+        "mupdf": f"pymupdf4llm-{version('pymupdf4llm')}",
+    }
+
+
+def page_hashes(pdf_path):
+    """Hashes what a page looks like: its content stream, its size, the raw
+    streams of its images and the names of its fonts."""
+    import pymupdf
+
+    hashes = []
+    with pymupdf.open(pdf_path) as document:
+        for page in document:
+            digest = hashlib.sha256()
+            digest.update(page.read_contents())
+            digest.update(str(tuple(page.rect)).encode())
+            for image in page.get_images(full=True):
+                digest.update(document.xref_stream_raw(image[0]) or b"")
+            for font in page.get_fonts(full=True):
+                digest.update(font[3].encode("utf-8", "replace"))
+            hashes.append(digest.hexdigest())
+    return hashes
+
+
+class PageCache:
+    def __init__(self, folder=PAGE_CACHE_FOLDER):
+        self.folder = folder
+
+    def _path(self, engine, page_hash):
+        return os.path.join(self.folder, engine, f"{page_hash}.mmd")
+
+    def get(self, engine, page_hash):
+        path = self._path(engine, page_hash)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def put(self, engine, page_hash, text):
+        path = self._path(engine, page_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+
+def page_ranges(pages, parts):
+    """Splits a list of pages into at most `parts` contiguous ranges."""
+    size = max(1, -(-len(pages) // max(1, parts)))
+    return [pages[start : start + size] for start in range(0, len(pages), size)]
+
+
+def mupdf_pages_to_markdown(pdf_path, pages):
+    import pymupdf4llm
+
+    chunks = pymupdf4llm.to_markdown(pdf_path, pages=pages, page_chunks=True)
+    return [chunk["text"] for chunk in chunks]
+
+
+def split_into_page_pdfs(pdf_path, pages, folder):
+    import pymupdf
+
+    page_paths = []
+    with pymupdf.open(pdf_path) as document:
+        for page in pages:
+            single_page = pymupdf.open()
+            single_page.insert_pdf(document, from_page=page, to_page=page)
+            page_path = os.path.join(folder, f"page_{page:05d}.pdf")
+            single_page.save(page_path)
+            single_page.close()
+            page_paths.append(page_path)
+    return page_paths
+
+
+def start_nougat(page_paths, output_folder):
+    command = [
+        "nougat",
+        *page_paths,
+        "--no-skipping",
+        "-o",
+        output_folder,
+        "-m",
+        NOUGAT_MODEL,
+    ]
+    return subprocess.Popen(command)
+
+
+def read_nougat_page(page_path, output_folder):
+    stem = os.path.splitext(os.path.basename(page_path))[0]
+    output_path = os.path.join(output_folder, f"{stem}.mmd")
+    # Nougat leaves no output for pages it could not read at all
+    if not os.path.exists(output_path):
+        return None
+    with open(output_path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def start_nougat_job(pdf_path, pages):
+    """Hands the pages to the nougat worker, or returns None if it is not
+    running (or there is nothing to convert)."""
+    if not pages:
+        return None
+    from nougat_worker import NougatJob
+
+    try:
+        return NougatJob(pdf_path, pages)
+    except ConnectionRefusedError:
+        return None
+
+
+def write_markdown(name, pages, separator="\n\n"):
+    path = os.path.join(MARKDOWN_FOLDER, f"{name}.mmd")
+    # No newline translation, so the byte offsets hold on every platform
+    text = separator.join(pages)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+    offsets = []
+    position = 0
+    for page in pages:
+        size = len(page.encode("utf-8"))
+        offsets.append([position, position + size])
+        position += size + len(separator.encode("utf-8"))
+    os.makedirs(PAGES_FOLDER, exist_ok=True)
+    with open(os.path.join(PAGES_FOLDER, f"{name}.json"), "w", encoding="utf-8") as f:
+        json.dump({"size": len(text.encode("utf-8")), "pages": offsets}, f)
+    return path
+
+
+def read_page_offsets(name, markdown_folder=MARKDOWN_FOLDER, pages_folder=PAGES_FOLDER):
+    """The [start, end) byte range of every page of files/markdowns/{name}.mmd,
+    or None if the markdown did not come from a page-by-page conversion (or
+    has been edited since)."""
+    path = os.path.join(pages_folder, f"{name}.json")
+    markdown_path = os.path.join(markdown_folder, f"{name}.mmd")
+    if not os.path.exists(path) or not os.path.exists(markdown_path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        page_map = json.load(f)
+    if page_map["size"] != os.path.getsize(markdown_path):
+        return None
+    return page_map["pages"]
+
+
+def convert_pdf(
+    pdf_name,
+    mupdf_workers=MUPDF_WORKERS,
+    nougat_workers=NOUGAT_WORKERS,
+    page_cache=None,
+):
+    """Converts files/pdfs/{pdf_name}.pdf into {pdf_name}.mmd (Nougat) and
+    mu_{pdf_name}.mmd (MuPDF). Raises CalledProcessError if the Nougat CLI
+    fails and NougatWorkerError if the worker does."""
+    if page_cache == None:
+        page_cache = PageCache()
+    engines = engine_versions()
+    pdf_path = os.path.join(PDF_FOLDER, f"{pdf_name}.pdf")
+    hashes = page_hashes(pdf_path)
+    nougat_pages = [page_cache.get(engines["nougat"], h) for h in hashes]
+    mupdf_pages = [page_cache.get(engines["mupdf"], h) for h in hashes]
+    nougat_missing = [page for page, text in enumerate(nougat_pages) if text is None]
+    mupdf_missing = [page for page, text in enumerate(mupdf_pages) if text is None]
+    print(
+        f"{len(hashes)} pages: {len(nougat_missing)} new for nougat, {len(mupdf_missing)} new for mupdf"
+    )
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        nougat_job = start_nougat_job(pdf_path, nougat_missing)
+        page_paths = []
+        processes = []
+        output_folder = os.path.join(temp_folder, "nougat")
+        try:
+            if nougat_job == None:
+                page_paths = split_into_page_pdfs(pdf_path, nougat_missing, temp_folder)
+                print("Processing the PDF with nougat...")
+                # Appended one by one, so a failing start still kills the
+                # processes started before it
+                for shard in page_ranges(page_paths, nougat_workers):
+                    processes.append(start_nougat(shard, output_folder))
+            else:
+                print("Processing the PDF with the nougat worker...")
+
+            # MuPDF runs while the Nougat workers are busy
+            print("Processing the PDF with mupdf...")
+            ranges = page_ranges(mupdf_missing, mupdf_workers)
+            with ProcessPoolExecutor(max_workers=max(1, len(ranges))) as executor:
+                results = executor.map(
+                    mupdf_pages_to_markdown, [pdf_path] * len(ranges), ranges
+                )
+                for pages, texts in zip(ranges, results):
+                    for page, text in zip(pages, texts):
+                        mupdf_pages[page] = text
+                        page_cache.put(engines["mupdf"], hashes[page], text)
+            write_markdown("mu_" + pdf_name, mupdf_pages)
+        except BaseException:
+            for process in processes:
+                process.kill()
+            if nougat_job != None:
+                nougat_job.cancel()
+            raise
+
+        if nougat_job != None:
+            for page, text in nougat_job.wait().items():
+                nougat_pages[page] = text
+                page_cache.put(engines["nougat"], hashes[page], text)
+
+        failed = [process for process in processes if process.wait() != 0]
+        if failed:
+            raise subprocess.CalledProcessError(failed[0].returncode, failed[0].args)
+        for page, page_path in zip(nougat_missing, page_paths):
+            text = read_nougat_page(page_path, output_folder)
+            if text is None:
+                nougat_pages[page] = ""
+            else:
+                nougat_pages[page] = text
+                page_cache.put(engines["nougat"], hashes[page], text)
+        write_markdown(pdf_name, nougat_pages)
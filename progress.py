@@ -0,0 +1,21 @@
+import contextvars
+
+
+### Progress of the tool that is running, for whoever started it (the job
+### queue of the Streamlit app). The loops over chunks and pages report to the
+### listener of the current context; without a listener, reporting does
+### nothing and the tqdm bars in the terminal are all there is.
+progress_listener = contextvars.ContextVar("progress_listener", default=None)
+
+
+def report_progress(done, total):
+    listener = progress_listener.get()
+    if listener != None:
+        listener.progress(done, total)
+
+
+def report_output(path):
+    """Tells the listener which file the output is being written to."""
+    listener = progress_listener.get()
+    if listener != None:
+        listener.output(path)
@@ -15,6 +15,9 @@ tasks in the field of academics.
 6. **Translate Markdown:** Translates Markdown files to different languages, using context from a second file (usually keywords and summaries) for community-specific translation.
 7. **Take a Peek:** Allows the LLM to quickly look at a file and answer questions like "What is this text about?" It can also be used to get citations from a citation file and feed them to another tool later.
 8. **Citation Retriever:** Finds citations that satisfy specific criteria (e.g., female author, appears in a math proof, etc.).
+9. **Fetch a Bibliography:** Retrieves every paper of a long bibliography from arXiv at once, without going through the references one by one. Prefer it over Fetch PDFs for more than a handful of references.
+10. **Ask the Library:** Answers a question from every Markdown file in the local library at once, citing the paper and page each part of the answer comes from. Prefer it over Take a Peek for questions about what the papers say.
+11. **PDF to Markdown (Vision):** Converts PDF files to Markdown by sending the image of every page to the vision model in parallel. Needs no GPU and is much faster than Nougat on a CPU. Suggest it when the user has no Nvidia GPU.
 
 **Workflow:**
 - **Translation Request:** If a user requests a translation, ask if they have an auxiliary text or if they want one created from the main file. Suggest calling the Summarize and Extract Keywords tool to create the auxiliary text, but proceed only if the user agrees. Use the resulting file as context for the translation.
@@ -103,6 +106,13 @@ Dynamic Programming, and Bayesian Inference; applications such as Image Recognit
 and Data Mining; and algorithms like Neural Networks, Sorting Algorithms, and Graph Algorithms.
 """
 
+keyword_and_summary_merger_system_template = """You are a multilingual expert mathematician or computer scientist tasked with 
+generating keywords and summarizing research papers. You receive several partial lists of keywords and summaries, each one 
+written for a consecutive part of the same paper, in the order they appear in the paper. Merge them into a single set of 
+keywords (keep only the important ones and remove duplicates) and a single short summary (in English) of the whole part 
+they cover. Respond only with the merged keywords and summary, in the same format as the partial ones.
+"""
+
 
 citiation_fixer_system_template = """You are an expert librarian with the following task: You receive a good text from a very reliable source 
 and several bad texts from another source. The good text has numerical citations  
@@ -151,6 +161,16 @@ Note: Focus solely on extracting the relevant citations without providing any ad
 citation_cleaner_system_template = """You are a scholar. You get a test with different citations. Please bring back only the citations that have
 description after them. Try to not duplicate"""
 
+vision_transcriber_system_template = """You are an expert transcriber of scientific documents. You receive the image of a single page of a paper. 
+Transcribe it into Markdown exactly as it is written, in its original language: keep the headings, lists, tables and footnotes, write every 
+formula in LaTeX (\\( ... \\) inline, \\[ ... \\] for display math) and keep the citation markers as they appear. Skip running headers and page 
+numbers. Respond only with the transcription and nothing else."""
+
+question_answering_system_template = """You are a distinguished scholar answering questions about a library of scientific papers. 
+You receive a question and a few excerpts from the papers, each one headed by the paper it comes from and its page (when known). 
+Answer using only these excerpts. After every claim, cite its source as (paper, p. page). If the excerpts do not answer the 
+question, say so instead of guessing."""
+
 supervisor_prompt_template = ChatPromptTemplate.from_messages(
     [
         ("system", supervisor_system_template),
@@ -296,3 +316,17 @@ keyword_and_summary_maker_template = ChatPromptTemplate.from_messages(
         ),
     ]
 )
+
+keyword_and_summary_merger_template = ChatPromptTemplate.from_messages(
+    [
+        ("system", keyword_and_summary_merger_system_template),
+        ("user", "Here are the partial keywords and summaries, in order:\n{summaries}"),
+    ]
+)
+
+question_answering_prompt_template = ChatPromptTemplate.from_messages(
+    [
+        ("system", question_answering_system_template),
+        ("user", "Excerpts:\n{context}\n\nQuestion: {question}"),
+    ]
+)
@@ -0,0 +1,233 @@
+import asyncio, os, random, threading, time
+from langchain_google_genai import ChatGoogleGenerativeAI
+from cancellation import current_token
+
+
+### One process-wide limiter in front of every Gemini chat call. Two token
+### buckets keep the request rate and the token rate under the quota, and an
+### AIMD controller sets how many requests may be in flight: one more slot
+### for every window of successes, half as many after a 429/503. Throttled
+### requests are retried with jittered exponential backoff, so a workflow
+### slows down instead of failing halfway through a document. A request of a
+### cancelled run gives up while it waits for its turn or backs off.
+###
+### The quota defaults to the free tier of gemini-1.5-flash; set GEMINI_RPM,
+### GEMINI_TPM and GEMINI_MAX_CONCURRENCY for a paid one.
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "15"))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "1000000"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+RETRYABLE_ERRORS = {
+    "ResourceExhausted",
+    "TooManyRequests",
+    "ServiceUnavailable",
+    "InternalServerError",
+    "DeadlineExceeded",
+}
+
+
+def is_retryable(error):
+    """Rate limits (429) and overloaded or flaky servers (500, 503, 504)."""
+    if type(error).__name__ in RETRYABLE_ERRORS:
+        return True
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return code in (429, 500, 503, 504)
+
+
+class TokenBucket:
+    """Refills `rate_per_minute` units per minute, up to one minute's worth."""
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.level = rate_per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` units are available (0 if they are now)."""
+        self._refill(time.monotonic())
+        # A request larger than the bucket only has to wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill(time.monotonic())
+        self.level -= amount
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute=GEMINI_RPM,
+        tokens_per_minute=GEMINI_TPM,
+        max_concurrency=GEMINI_MAX_CONCURRENCY,
+        initial_concurrency=2,
+        max_retries=8,
+        base_delay=1.0,
+        max_delay=60.0,
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(min(initial_concurrency, max_concurrency))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.throttled = 0
+        self._condition = threading.Condition()
+
+    def _try_start(self, tokens):
+        """Takes a slot and the quota for one request, or returns how long to
+        wait before trying again. Called with the condition held."""
+        if self.in_flight >= int(self.concurrency):
+            return None
+        delay = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+        if delay > 0:
+            return delay
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.in_flight += 1
+        return 0.0
+
+    def acquire(self, tokens, token=None):
+        with self._condition:
+            while True:
+                if token != None:
+                    token.check()
+                delay = self._try_start(tokens)
+                if delay == 0.0:
+                    return
+                # Without a slot there is no delay, only a release to wait for
+                if token != None:
+                    delay = min(delay or 1.0, 1.0)
+                    remaining = token.remaining()
+                    if remaining != None:
+                        delay = min(delay, remaining)
+                self._condition.wait(delay)
+
+    def release(self, succeeded, output_tokens=0):
+        """Frees the slot of a request. True widens the window, False (the
+        server pushed back) halves it, None (the request failed for another
+        reason) leaves it as it is."""
+        with self._condition:
+            self.in_flight -= 1
+            # The answer counts against the token quota as well
+            self.tokens.take(output_tokens)
+            if succeeded:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1.0 / self.concurrency
+                )
+            elif succeeded == False:
+                self.throttled += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+            self._condition.notify_all()
+
+    def backoff(self, attempt):
+        """Full jitter: a random delay up to the exponential bound."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def call(self, function, tokens, output_tokens=lambda result: 0):
+        token = current_token.get()
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens, token)
+            try:
+                result = function()
+            except Exception as e:
+                # Only a throttled request says anything about the quota
+                self.release(False if is_retryable(e) else None)
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                if token == None:
+                    time.sleep(self.backoff(attempt))
+                elif token.wait(self.backoff(attempt)):
+                    token.check()
+                continue
+            self.release(True, output_tokens(result))
+            return result
+
+    async def acall(self, coroutine_function, tokens, output_tokens=lambda result: 0):
+        token = current_token.get()
+        for attempt in range(self.max_retries + 1):
+            await asyncio.to_thread(self.acquire, tokens, token)
+            try:
+                result = await coroutine_function()
+            except Exception as e:
+                # Only a throttled request says anything about the quota
+                self.release(False if is_retryable(e) else None)
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+            self.release(True, output_tokens(result))
+            return result
+
+    def stats(self):
+        with self._condition:
+            return {
+                "concurrency": self.concurrency,
+                "in_flight": self.in_flight,
+                "throttled": self.throttled,
+            }
+
+
+gemini_limiter = RateLimiter()
+
+
+# What Gemini charges for an image, whatever its size
+IMAGE_TOKENS = 258
+
+
+def content_tokens(content):
+    if isinstance(content, str):
+        return len(content) // 4
+    tokens = 0
+    for part in content:
+        if isinstance(part, dict) and part.get("type") == "image_url":
+            tokens += IMAGE_TOKENS
+        else:
+            tokens += len(str(part)) // 4
+    return tokens
+
+
+def message_tokens(messages):
+    return sum(content_tokens(message.content) for message in messages) + 1
+
+
+def result_tokens(result):
+    return sum(
+        len(str(generation.message.content)) for generation in result.generations
+    ) // 4
+
+
+class RateLimitedChatGoogleGenerativeAI(ChatGoogleGenerativeAI):
+    """ChatGoogleGenerativeAI whose calls go through gemini_limiter. Answers
+    from the LLM cache never reach _generate, so they are not limited."""
+
+    def __init__(self, **kwargs):
+        # The limiter does the retrying, with the quota in mind
+        kwargs.setdefault("max_retries", 1)
+        super().__init__(**kwargs)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return gemini_limiter.call(
+            lambda: super(RateLimitedChatGoogleGenerativeAI, self)._generate(
+                messages, stop=stop, run_manager=run_manager, **kwargs
+            ),
+            message_tokens(messages),
+            result_tokens,
+        )
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return await gemini_limiter.acall(
+            lambda: super(RateLimitedChatGoogleGenerativeAI, self)._agenerate(
+                messages, stop=stop, run_manager=run_manager, **kwargs
+            ),
+            message_tokens(messages),
+            result_tokens,
+        )
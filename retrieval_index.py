@@ -0,0 +1,244 @@
+import bisect, hashlib, math, os, re, sqlite3, threading
+from collections import Counter
+import numpy as np
+from embedding_store import EmbeddingStore
+from pdf_conversion import MARKDOWN_FOLDER, PDF_FOLDER, read_page_offsets
+from text_chunking import chunk_file
+
+
+### Hybrid search over the markdowns of files/markdowns. Every file is cut into
+### small chunks that keep their byte offsets and the PDF page they come from.
+### A BM25 inverted index (SQLite) finds the chunks that share words with the
+### question, the embeddings (kept on disk by EmbeddingStore) find the ones
+### that mean the same, and the two rankings are fused. Only files that were
+### added or changed since the last update are indexed again.
+###
+### A namespace names the index of one markdown folder. The app has a single
+### library (every tool reads and writes files/markdowns), so it keeps a
+### single "default" index that every session shares and updates; a separate
+### corpus needs its own markdown_folder and namespace.
+INDEX_FOLDER = os.path.join("files", "cache", "index")
+WORD = re.compile(r"\w{2,}")
+
+
+def safe_namespace(namespace):
+    """The namespace as a folder name: letters, digits, - and _ only, with a
+    hash of the original when anything had to be replaced."""
+    safe = re.sub(r"[^A-Za-z0-9_-]", "_", namespace)[:64]
+    if safe != namespace:
+        digest = hashlib.sha256(namespace.encode("utf-8")).hexdigest()[:12]
+        safe = f"{safe}-{digest}"
+    return safe
+
+
+def tokenize(text):
+    return [word.lower() for word in WORD.findall(text)]
+
+
+def source_pdf(document, pdf_folder=PDF_FOLDER):
+    """The PDF a markdown was converted from, if it is still around."""
+    name = document[3:] if document.startswith("mu_") else document
+    path = os.path.join(pdf_folder, f"{name}.pdf")
+    return path if os.path.exists(path) else None
+
+
+class HybridIndex:
+    def __init__(
+        self,
+        namespace="default",
+        markdown_folder=MARKDOWN_FOLDER,
+        embedder=None,
+        embedding_store=None,
+        chunk_tokens=250,
+        k1=1.5,
+        b=0.75,
+    ):
+        self.namespace = safe_namespace(namespace)
+        self.markdown_folder = markdown_folder
+        # Without an embedder the index falls back to BM25 alone
+        self.embedder = embedder
+        if embedding_store == None:
+            self.embedding_store = EmbeddingStore()
+        else:
+            self.embedding_store = embedding_store
+        self.chunk_tokens = chunk_tokens
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._vectors = None
+        folder = os.path.join(INDEX_FOLDER, self.namespace)
+        os.makedirs(folder, exist_ok=True)
+        self._connection = sqlite3.connect(
+            os.path.join(folder, "index.sqlite"), check_same_thread=False
+        )
+        self._connection.executescript(
+            """CREATE TABLE IF NOT EXISTS documents (
+                name TEXT PRIMARY KEY,
+                hash TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                document TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                page INTEGER,
+                length INTEGER NOT NULL,
+                text TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                chunk INTEGER NOT NULL,
+                tf INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+            CREATE INDEX IF NOT EXISTS postings_chunk ON postings (chunk);
+            CREATE INDEX IF NOT EXISTS chunks_document ON chunks (document);"""
+        )
+        self._connection.commit()
+
+    def _remove(self, name):
+        self._connection.execute(
+            "DELETE FROM postings WHERE chunk IN (SELECT id FROM chunks WHERE document = ?)",
+            (name,),
+        )
+        self._connection.execute("DELETE FROM chunks WHERE document = ?", (name,))
+        self._connection.execute("DELETE FROM documents WHERE name = ?", (name,))
+
+    def _add(self, name, path, file_hash):
+        pages = read_page_offsets(name, self.markdown_folder)
+        page_starts = [start for start, _ in pages] if pages else None
+        for chunk in chunk_file(path, self.chunk_tokens):
+            terms = Counter(tokenize(chunk["text"]))
+            if not terms:
+                continue
+            page = None
+            if page_starts:
+                page = bisect.bisect_right(page_starts, chunk["start"])
+            chunk_id = self._connection.execute(
+                "INSERT INTO chunks (document, start, end, page, length, text) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    name,
+                    chunk["start"],
+                    chunk["end"],
+                    page,
+                    sum(terms.values()),
+                    chunk["text"],
+                ),
+            ).lastrowid
+            self._connection.executemany(
+                "INSERT INTO postings VALUES (?, ?, ?)",
+                [(term, chunk_id, tf) for term, tf in terms.items()],
+            )
+        self._connection.execute(
+            "INSERT INTO documents VALUES (?, ?)", (name, file_hash)
+        )
+
+    def update(self):
+        """Indexes the new and changed markdowns and forgets the deleted ones.
+        Returns the number of files that were (re)indexed."""
+        files = {}
+        if os.path.isdir(self.markdown_folder):
+            for file in os.listdir(self.markdown_folder):
+                if file.endswith(".mmd"):
+                    files[file[: -len(".mmd")]] = os.path.join(
+                        self.markdown_folder, file
+                    )
+        changed = 0
+        with self._lock:
+            known = dict(
+                self._connection.execute("SELECT name, hash FROM documents").fetchall()
+            )
+            for name in set(known) - set(files):
+                self._remove(name)
+            for name, path in sorted(files.items()):
+                with open(path, "rb") as f:
+                    file_hash = hashlib.sha256(f.read()).hexdigest()
+                if known.get(name) == file_hash:
+                    continue
+                self._remove(name)
+                self._add(name, path, file_hash)
+                changed += 1
+            self._connection.commit()
+            if changed or set(known) - set(files):
+                self._vectors = None
+        if changed:
+            print(f"Indexed {changed} new or changed files")
+        return changed
+
+    def _bm25(self, question, limit):
+        terms = set(tokenize(question))
+        if not terms:
+            return []
+        total, average = self._connection.execute(
+            "SELECT COUNT(*), AVG(length) FROM chunks"
+        ).fetchone()
+        if not total:
+            return []
+        scores = Counter()
+        for term in terms:
+            rows = self._connection.execute(
+                "SELECT postings.chunk, postings.tf, chunks.length FROM postings "
+                "JOIN chunks ON chunks.id = postings.chunk WHERE postings.term = ?",
+                (term,),
+            ).fetchall()
+            idf = math.log(1 + (total - len(rows) + 0.5) / (len(rows) + 0.5))
+            for chunk_id, tf, length in rows:
+                scores[chunk_id] += (
+                    idf
+                    * tf
+                    * (self.k1 + 1)
+                    / (tf + self.k1 * (1 - self.b + self.b * length / average))
+                )
+        return [chunk_id for chunk_id, _ in scores.most_common(limit)]
+
+    def _vector_search(self, question, limit):
+        if self.embedder == None:
+            return []
+        if self._vectors == None:
+            rows = self._connection.execute("SELECT id, text FROM chunks").fetchall()
+            if not rows:
+                return []
+            vectors = self.embedding_store.embed_documents(
+                self.embedder, [text for _, text in rows]
+            )
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            self._vectors = ([chunk_id for chunk_id, _ in rows], vectors / norms)
+        ids, vectors = self._vectors
+        query = np.asarray(self.embedder.embed_query(question), dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        similarities = vectors @ query
+        top = np.argsort(-similarities)[:limit]
+        return [ids[i] for i in top]
+
+    def search(self, question, k=5, candidates=50, fusion_k=60):
+        """The k best chunks for the question: reciprocal rank fusion of the
+        BM25 and the embedding rankings. Every hit carries its document, the
+        source PDF, its page (None if unknown) and its byte offsets."""
+        with self._lock:
+            rankings = [
+                self._bm25(question, candidates),
+                self._vector_search(question, candidates),
+            ]
+            fused = Counter()
+            for ranking in rankings:
+                for rank, chunk_id in enumerate(ranking):
+                    fused[chunk_id] += 1.0 / (fusion_k + rank + 1)
+            hits = []
+            for chunk_id, score in fused.most_common(k):
+                document, start, end, page, text = self._connection.execute(
+                    "SELECT document, start, end, page, text FROM chunks WHERE id = ?",
+                    (chunk_id,),
+                ).fetchone()
+                hits.append(
+                    {
+                        "document": document,
+                        "pdf": source_pdf(document),
+                        "page": page,
+                        "start": start,
+                        "end": end,
+                        "text": text,
+                        "score": score,
+                    }
+                )
+        return hits
@@ -1,14 +1,31 @@
-import urllib, os, subprocess, pathlib, pymupdf4llm
+import urllib.request, os, subprocess, pathlib
 from langchain_core.tools import tool
+from arxiv_index import ArxivIndex
+from downloads import stream_download
+
+arxiv_index = None
+
+
+def get_arxiv_index():
+    global arxiv_index
+    if arxiv_index == None:
+        arxiv_index = ArxivIndex()
+    return arxiv_index
 
 
 @tool
 def get_id_from_url(url: str) -> str:
     """This is a search tool inside arxiv.
     it takes a query in the form of a urland returns  metadata like the id of the paper that answers better to the query."""
+    cached = get_arxiv_index().lookup_url(url)
+    if cached is not None:
+        print("Found the query in the local arXiv index")
+        return cached
     try:
         with urllib.request.urlopen(url) as response:
-            return response.read()
+            metadata = response.read().decode("utf-8")
+        get_arxiv_index().add_response(metadata, url)
+        return metadata
     except urllib.error.HTTPError as e:
         # Handle HTTP errors (e.g., 404, 500)
         print(f"HTTPError: {e.code} - {e.reason}")
@@ -29,47 +46,46 @@ def download_pdf(id: str, title: str) -> str:
     corresponding to the id and saves it."""
 
     url = f"https://arxiv.org/pdf/{id}.pdf"
-    save_path = os.path.join(r"files\pdfs", f"{title}.pdf")
-    # Send a GET request to the URL
-    response = urllib.request.urlopen(url)
-
-    # Check if the request was successful
-    if response.status == 200:
-        # Open a file in write-binary mode and write the response content to it
-        with open(save_path, "wb") as file:
-            file.write(response.read())
-        a = f"PDF has been downloaded successfully and saved to {save_path}"
+    save_path = os.path.join("files", "pdfs", f"{title}.pdf")
+    status = stream_download(url, save_path)
+    if status == "unchanged":
+        a = f"PDF is already downloaded and up to date at {save_path}"
     else:
-        a = f"Error. Failed to download PDF. Status code: {response.status}"
+        a = f"PDF has been downloaded successfully and saved to {save_path}"
     return a
 
 
 @tool
 def pdf_to_markdown(pdf_name: str) -> str:
     """This method takes as input the name of a pdf it turns it to markdown"""
+    from pdf_conversion import convert_pdf
+    from nougat_worker import NougatWorkerError
+
     pdf_name = get_filename_without_extension(pdf_name)
-    mupdf_name = "mu_" + pdf_name
-    pdf_path = os.path.join(r"files\pdfs", f"{pdf_name}.pdf")
-    print("Processing the PDF with mupdf...")
-    mupdf_path = os.path.join(r"files\markdowns", f"{mupdf_name}.mmd")
-    print("Processing the PDF with nugat...")
-    md_text = pymupdf4llm.to_markdown(pdf_path)
-    pathlib.Path(mupdf_path).write_bytes(md_text.encode())
-    # Define the command as a list of arguments
-    command = [
-        "nougat",
-        pdf_path,
-        "--no-skipping",
-        "-o",
-        "files\\markdowns",
-        "-m",
-        "0.1.0-base",
-    ]
-    # Execute the command
+    # MuPDF and Nougat run side by side, each spread over several processes
     try:
-        subprocess.check_call(command)
+        convert_pdf(pdf_name)
         response = "File" + pdf_name + "_converted successfully"
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, NougatWorkerError) as e:
+        response = "Error occurred while converting the file" + pdf_name + ":" + str(e)
+    print(response)
+    return response
+
+
+@tool
+def pdf_to_markdown_vision(pdf_name: str) -> str:
+    """This method takes as input the name of a pdf and turns it to markdown
+    with the vision model, page by page. It needs no GPU."""
+    from vision_conversion import convert_pdf_with_vision
+
+    pdf_name = get_filename_without_extension(pdf_name)
+    # Every page is rendered to an image and transcribed in parallel
+    try:
+        failed = convert_pdf_with_vision(pdf_name)
+        response = "File" + pdf_name + "_converted successfully"
+        if failed:
+            response += ", except for pages " + ", ".join(map(str, failed))
+    except Exception as e:
         response = "Error occurred while converting the file" + pdf_name + ":" + str(e)
     print(response)
     return response
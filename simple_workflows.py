@@ -1,18 +1,41 @@
 from langgraph.graph import END, StateGraph
-from langchain_core.messages import BaseMessage, ToolMessage, HumanMessage
+from langchain_core.messages import BaseMessage, ToolMessage, HumanMessage, AIMessage
 from langgraph.prebuilt import ToolInvocation
 from langgraph.prebuilt.tool_executor import ToolExecutor
 from typing import TypedDict, Annotated
-from langchain_google_genai import ChatGoogleGenerativeAI
+from model_pool import get_chat_model, get_embeddings
 import operator
 from tqdm import tqdm
 from prompts import *
 from simple_tools import *
-from langchain_text_splitters import CharacterTextSplitter
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-import torch
+from chunk_runner import run_chunks, iter_chunks
+from output_writer import write_chunks
+from checkpointing import ChunkJournal
+from cancellation import get_token, check_cancelled
+from arxiv_index import read_entries, best_entry
+from bibliography import (
+    parse_references,
+    index_bibliography,
+    new_entries,
+    text_before_references,
+    CitationIndex,
+)
 import os
-from sentence_transformers import util
+from text_chunking import (
+    chunk_file,
+    split_file,
+    chunk_text,
+    has_proof_markers,
+    chunk_budget,
+    prompt_overhead,
+    estimate_tokens,
+    TARGET_TOKENS,
+    CHARS_PER_TOKEN,
+    EMBEDDING_INPUT_TOKENS,
+)
+
+# Finished chunks of the runs in progress, so an interrupted run can resume
+chunk_journal = ChunkJournal()
 
 
 class ArxivState(TypedDict):
@@ -53,6 +76,12 @@ class CitationExtractorState(TypedDict):
     main_text_filename: BaseMessage
     extraction_type: BaseMessage
     auxilary_text_filename: BaseMessage
+    auxilary_text: str
+    chunks: list[str]
+    references: list[dict]
+    unresolved_pages: list[int]
+    list_of_citations: str
+    bibliography_pages: list[int]
     report: BaseMessage
 
 
@@ -61,21 +90,26 @@ class TakeAPeakState(TypedDict):
     report: BaseMessage
 
 
+class QuestionAnsweringState(TypedDict):
+    question: BaseMessage
+    report: BaseMessage
+
+
 class ArxivRetrievalWorkflow:
     def __init__(
         self, retriever_model=None, cleaner_model=None, receptionist_model=None
     ):
         if retriever_model == None:
-            self.retriever_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.retriever_model = get_chat_model()
         else:
             self.retriever_model = retriever_model
 
         if cleaner_model == None:
-            self.cleaner_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.cleaner_model = get_chat_model()
         else:
             self.cleaner_model = cleaner_model
         if receptionist_model == None:
-            self.receptionist_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.receptionist_model = get_chat_model()
         else:
             self.receptionist_model = receptionist_model
 
@@ -88,7 +122,8 @@ class ArxivRetrievalWorkflow:
         self.receptionist = arxiv_receptionist_prompt_template | self.receptionist_model
         self.tool_executor = ToolExecutor(self.tools)
 
-    def run_receptionist(self, state):
+    def run_receptionist(self, state, config=None):
+        check_cancelled(config)
         action = self.receptionist.invoke(state)
         if "We are done" in action.content:
             pr = "Receptionist" + action.content
@@ -105,7 +140,8 @@ class ArxivRetrievalWorkflow:
             "history_reset_counter": len(state["last_action_outcome"]),
         }
 
-    def run_retriever(self, state):
+    def run_retriever(self, state, config=None):
+        check_cancelled(config)
         state["last_action_outcome"] = state["last_action_outcome"][
             state["history_reset_counter"] :
         ]
@@ -159,6 +195,22 @@ class ArxivRetrievalWorkflow:
                 + str(tool_call["args"])
             )
             print(pr)
+            # Well-formed API responses are scraped here; the cleaner LLM is
+            # only needed for errors and anything that does not parse.
+            entries = read_entries(response.content)
+            if entries:
+                paper = best_entry(str(state["article_keywords"]), entries)
+                scraped = AIMessage(
+                    content=f'The most relevant arXiv paper to the querry  is "{paper["title"]}" '
+                    f'and its id-url is "http://arxiv.org/abs/{paper["id"]}{paper["version"]}".'
+                )
+                print("Scraper: I got the following paper" + scraped.content)
+                return {
+                    "last_action_outcome": [report, scraped],
+                    "metadata": response,
+                    "title_of_retrieved_paper": paper["title"],
+                    "should_I_clean": False,
+                }
             return {
                 "last_action_outcome": [report],
                 "metadata": response,
@@ -234,65 +286,83 @@ class ArxivRetrievalWorkflow:
 
 
 class OcrEnchancingWorkflow:
-    def __init__(self, enhancer_model=None, embeder=None):
+    def __init__(
+        self,
+        enhancer_model=None,
+        embeder=None,
+        embedding_store=None,
+        target_tokens=TARGET_TOKENS,
+    ):
         if enhancer_model == None:
-            self.enhancer_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.enhancer_model = get_chat_model(cached=True)
         else:
             self.enhancer_model = enhancer_model
         if embeder == None:
-            self.embeder = GoogleGenerativeAIEmbeddings(
-                model="models/text-embedding-004"
-            )
+            self.embeder = get_embeddings()
         else:
             self.embeder = embeder
+        # numpy is only needed here, so it is not imported with the module
+        from embedding_store import EmbeddingStore
+
+        if embedding_store == None:
+            self.embedding_store = EmbeddingStore()
+        else:
+            self.embedding_store = embedding_store
+        # Size of a whole enhancer request: one main chunk and two supporting ones
+        self.target_tokens = target_tokens
 
         self.enhancer = ocr_enhancer_prompt_template | self.enhancer_model
 
-    def run_enhancer(self, state):
-        text_splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=0)
+    def run_enhancer(self, state, config=None):
+        from text_alignment import align_chunks
+
         main_text_filename = state["main_text_filename"].content
         main_text_filename = get_filename_without_extension(main_text_filename)
         supporting_text_filename = state["supporting_text_filename"].content
         supporting_text_filename = get_filename_without_extension(
             supporting_text_filename
         )
-        with open(
-            f"files/markdowns/{supporting_text_filename}.mmd", encoding="utf-8"
-        ) as f:
-            supporting = f.read()
-
-        with open(f"files/markdowns/{main_text_filename}.mmd", encoding="utf-8") as f:
-            main = f.read()
-
-        supporting_splitted_list = text_splitter.split_text(supporting)
-        main_splitted_list = text_splitter.split_text(main)
-        good_embed = self.embeder.embed_documents(main_splitted_list)
-        bad_embed = self.embeder.embed_documents(supporting_splitted_list)
-        similarities = util.pytorch_cos_sim(good_embed, bad_embed)
+        overhead = prompt_overhead(ocr_enhancer_prompt_template)
+        max_tokens = chunk_budget(
+            (self.target_tokens - overhead) // 3, output_ratio=1.0
+        )
+        supporting_splitted_list = split_file(
+            f"files/markdowns/{supporting_text_filename}.mmd", max_tokens
+        )
+        main_splitted_list = split_file(
+            f"files/markdowns/{main_text_filename}.mmd", max_tokens
+        )
+        # The chunks are longer than the embedder takes in, so they are embedded
+        # as windows; a quarter is left for text with more tokens than estimated
+        window_chars = EMBEDDING_INPUT_TOKENS * 3 // 4 * CHARS_PER_TOKEN
+        good_embed = self.embedding_store.embed_long_documents(
+            self.embeder, main_splitted_list, window_chars
+        )
+        bad_embed = self.embedding_store.embed_long_documents(
+            self.embeder, supporting_splitted_list, window_chars
+        )
+        # The two supporting chunks closest to each main chunk, in reading order
+        pairing = align_chunks(good_embed, bad_embed, k=2)
         print("Enhancing started")
-        for i in tqdm(range(len(main_splitted_list))):
-            main_text_indexed = main_splitted_list[i]
-            supporting_text_temp = ""
-            values, indices = torch.topk(similarities[i], 2)
-            for index in indices:
-                supporting_text_indexed = (
-                    supporting_text_temp + supporting_splitted_list[index]
-                )
-            result = remove_up_to_first_newline(
-                self.enhancer.invoke(
-                    input={
-                        "good_text": main_text_indexed,
-                        "bad_text": supporting_text_indexed,
-                    }
-                ).content
-            )
-            main_splitted_list[i] = result
-
-        reconstructed_text = "".join(main_splitted_list)
-        with open(
-            f"files/markdowns/{main_text_filename}_enhanced.mmd", "w", encoding="utf-8"
-        ) as file:
-            file.write(reconstructed_text)
+        inputs = [
+            {
+                "good_text": main_splitted_list[i],
+                "bad_text": "".join(
+                    supporting_splitted_list[index] for index in pairing[i]
+                ),
+            }
+            for i in range(len(main_splitted_list))
+        ]
+        # Every enhanced chunk is on disk as soon as it is done
+        checkpoint = chunk_journal.checkpoint("ocr_enhancer", inputs)
+        results = iter_chunks(
+            self.enhancer, inputs, checkpoint=checkpoint, token=get_token(config)
+        )
+        write_chunks(
+            f"files/markdowns/{main_text_filename}_enhanced.mmd",
+            (remove_up_to_first_newline(result.content) for result in results),
+        )
+        checkpoint.finish()
         return {"report": HumanMessage(content="Done!")}
 
     def create_workflow(self):
@@ -304,52 +374,78 @@ class OcrEnchancingWorkflow:
 
 
 class ProofRemovingWorkflow:
-    def __init__(self, remover_model=None, stamper_model=None):
+    def __init__(
+        self,
+        remover_model=None,
+        stamper_model=None,
+        max_concurrency=4,
+        target_tokens=TARGET_TOKENS,
+    ):
         if remover_model == None:
-            self.remover_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.remover_model = get_chat_model(cached=True)
         else:
             self.remover_model = remover_model
         if stamper_model == None:
-            self.stamper_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.stamper_model = get_chat_model(cached=True)
         else:
             self.stamper_model = stamper_model
+        # Number of chunks that are stamped or cleaned in parallel
+        self.max_concurrency = max_concurrency
+        self.target_tokens = target_tokens
         self.remover = proof_remover_prompt_template | self.remover_model
         self.stamper = proof_stamper_prompt_template | self.stamper_model
 
-    def run_stamper(self, state):
-        text_splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=0)
+    def run_stamper(self, state, config=None):
         main_text_filename = state["main_text_filename"].content
         main_text_filename = get_filename_without_extension(main_text_filename)
-        with open(
-            f"files/markdowns/{ main_text_filename}.mmd", "r", encoding="utf-8"
-        ) as f:
-            text = f.read()
-
-        listed_text = text_splitter.split_text(text)
+        # The remover gives the chunk back, so its answer bounds the chunk size
+        max_tokens = chunk_budget(
+            self.target_tokens,
+            prompt_overhead(proof_remover_prompt_template),
+            output_ratio=1.0,
+        )
+        chunks = chunk_file(f"files/markdowns/{ main_text_filename}.mmd", max_tokens)
+        listed_text = [chunk["text"] for chunk in chunks]
         print("Stamping phase is initiated.")
-        for i in tqdm(range(len(listed_text))):
-            is_proof = self.stamper.invoke(input={"text": listed_text[i]})
-            if is_proof.content == "Yes":
+        if has_proof_markers("".join(listed_text)):
+            # The splitter knows where the proofs are, no need to ask the model
+            for i, chunk in enumerate(chunks):
+                if chunk["continues_proof"]:
+                    listed_text[i] = (
+                        "(PROOF CONTINOUS FROM PREVIOUS PAGE)" + listed_text[i]
+                    )
+            return {"file": listed_text, "main_text_filename": main_text_filename}
+
+        # Every verdict only looks at its own chunk, so all chunks are classified
+        # first and the prefixes are applied to the following chunks afterwards.
+        inputs = [{"text": chunk} for chunk in listed_text]
+        checkpoint = chunk_journal.checkpoint("proof_stamper", inputs)
+        verdicts = run_chunks(
+            self.stamper, inputs, self.max_concurrency, checkpoint, get_token(config)
+        )
+        checkpoint.finish()
+        for i in range(len(listed_text) - 1):
+            if verdicts[i].content.strip() == "Yes":
                 listed_text[i + 1] = (
                     "(PROOF CONTINOUS FROM PREVIOUS PAGE)" + listed_text[i + 1]
                 )
 
         return {"file": listed_text, "main_text_filename": main_text_filename}
 
-    def run_remover(self, state):
+    def run_remover(self, state, config=None):
         listed_text = state["file"]
         main_text_filename = state["main_text_filename"]
         print("Proof removal in progress")
-        finalwithoutproofs = ""
-        for i in tqdm(range(len(listed_text))):
-            result = self.remover.invoke(input={"text": listed_text[i]}).content
-            finalwithoutproofs = finalwithoutproofs + result
-        with open(
+        inputs = [{"text": chunk} for chunk in listed_text]
+        checkpoint = chunk_journal.checkpoint("proof_remover", inputs)
+        results = iter_chunks(
+            self.remover, inputs, self.max_concurrency, checkpoint, get_token(config)
+        )
+        write_chunks(
             f"files/markdowns/{main_text_filename}_without_proofs.mmd",
-            "w",
-            encoding="utf-8",
-        ) as f:
-            f.write(finalwithoutproofs)
+            (result.content for result in results),
+        )
+        checkpoint.finish()
         report = (
             "The proofs were remove and the resulted file is named "
             + main_text_filename
@@ -369,31 +465,52 @@ class ProofRemovingWorkflow:
 
 
 class KeywordAndSummaryWorkflow:
-    def __init__(self, keyword_and_summary_maker_model=None):
+    def __init__(
+        self,
+        keyword_and_summary_maker_model=None,
+        mode="fold",
+        max_concurrency=4,
+        fan_in=4,
+        target_tokens=TARGET_TOKENS,
+        summary_tokens=2000,
+    ):
         if keyword_and_summary_maker_model == None:
-            self.keyword_and_summary_maker_model = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash"
-            )
+            self.keyword_and_summary_maker_model = get_chat_model(cached=True)
         else:
             self.keyword_and_summary_maker_model = keyword_and_summary_maker_model
+        # "fold" refines one summary page by page, "map_reduce" summarizes the
+        # pages in parallel and merges the partial summaries fan_in at a time.
+        self.mode = mode
+        self.max_concurrency = max_concurrency
+        self.fan_in = max(2, fan_in)
+        # Room left in every request for the summary carried from page to page
+        self.target_tokens = target_tokens
+        self.summary_tokens = summary_tokens
         self.keyword_and_summary_maker = (
             keyword_and_summary_maker_template | self.keyword_and_summary_maker_model
         )
+        self.keyword_and_summary_merger = (
+            keyword_and_summary_merger_template | self.keyword_and_summary_maker_model
+        )
 
-    def run_keyword_and_summary_maker(self, state):
+    def run_keyword_and_summary_maker(self, state, config=None):
         text_name = state["main_text_filename"].content
         text_name = get_filename_without_extension(text_name)
-        with open(f"files/markdowns/{text_name}.mmd", "r", encoding="utf-8") as f:
-            text = f.read()
-
-        text_splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=0)
-        text = text_splitter.split_text(text)
-        keyword_and_summary = ""
+        max_tokens = chunk_budget(
+            self.target_tokens,
+            prompt_overhead(keyword_and_summary_maker_template) + self.summary_tokens,
+        )
+        text = split_file(f"files/markdowns/{text_name}.mmd", max_tokens)
         print("keyword_and_summary in progress")
-        for i in tqdm(range(len(text))):
-            keyword_and_summary = self.keyword_and_summary_maker.invoke(
-                {"text": keyword_and_summary, "page": text[i]}
-            ).content
+        if self.mode == "map_reduce":
+            keyword_and_summary = self.map_reduce(text, get_token(config))
+        else:
+            keyword_and_summary = ""
+            for i in tqdm(range(len(text))):
+                check_cancelled(config)
+                keyword_and_summary = self.keyword_and_summary_maker.invoke(
+                    {"text": keyword_and_summary, "page": text[i]}
+                ).content
 
         output_filename = f"files/markdowns/{text_name}_keyword_and_summary.mmd"
         with open(output_filename, "w", encoding="utf-8") as file:
@@ -403,6 +520,34 @@ class KeywordAndSummaryWorkflow:
         print(report)
         return {"report": HumanMessage(content=report)}
 
+    def map_reduce(self, pages, token=None):
+        """Summarizes every page on its own, then merges neighbouring partial
+        summaries in rounds until one is left: O(log pages) rounds of calls."""
+        inputs = [{"text": "", "page": page} for page in pages]
+        checkpoint = chunk_journal.checkpoint("keyword_and_summary_map", inputs)
+        results = run_chunks(
+            self.keyword_and_summary_maker,
+            inputs,
+            self.max_concurrency,
+            checkpoint,
+            token,
+        )
+        summaries = [result.content for result in results]
+        while len(summaries) > 1:
+            groups = [
+                summaries[start : start + self.fan_in]
+                for start in range(0, len(summaries), self.fan_in)
+            ]
+            results = run_chunks(
+                self.keyword_and_summary_merger,
+                [{"summaries": "\n\n---\n\n".join(group)} for group in groups],
+                self.max_concurrency,
+                token=token,
+            )
+            summaries = [result.content for result in results]
+        checkpoint.finish()
+        return summaries[0] if summaries else ""
+
     def create_workflow(self):
         """
         Create a workflow that executes the keyword and summary extraction.
@@ -415,25 +560,25 @@ class KeywordAndSummaryWorkflow:
 
 
 class TranslationWorkflow:
-    def __init__(self, translator_model=None):
+    def __init__(
+        self, translator_model=None, max_concurrency=4, target_tokens=TARGET_TOKENS
+    ):
         if translator_model == None:
-            self.translator_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.translator_model = get_chat_model(cached=True)
         else:
             self.translator_model = translator_model
+        # Number of chunks that are translated in parallel
+        self.max_concurrency = max_concurrency
+        self.target_tokens = target_tokens
         self.translator = translator_prompt_template | self.translator_model
 
-    def run_translator(self, state):
+    def run_translator(self, state, config=None):
         auxilary_text_filename = state["auxilary_text_filename"].content
         target_language = state["target_language"].content
         main_text_filename = state["main_text_filename"].content
         main_text_filename = get_filename_without_extension(main_text_filename)
         auxilary_text_filename = get_filename_without_extension(auxilary_text_filename)
 
-        text_splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=0)
-        with open(
-            f"files/markdowns/{main_text_filename}.mmd", "r", encoding="utf-8"
-        ) as f:
-            text = f.read()
         try:
             with open(
                 f"files/markdowns/{auxilary_text_filename}.mmd", "r", encoding="utf-8"
@@ -445,32 +590,51 @@ class TranslationWorkflow:
             )
             auxilary_text = " "
 
+        # Every request repeats the auxilary text, and translations come out
+        # longer than the original, so both shrink the chunks
+        max_tokens = chunk_budget(
+            self.target_tokens,
+            prompt_overhead(
+                translator_prompt_template,
+                auxilary_text=auxilary_text,
+                language=target_language,
+            ),
+            output_ratio=1.5,
+        )
+        listed_text = split_file(
+            f"files/markdowns/{main_text_filename}.mmd", max_tokens
+        )
+
         if "_without_proofs" in main_text_filename:
             main_text_filename = main_text_filename.replace("_without_proofs", "")
 
-        listed_text = text_splitter.split_text(text)
-        translation = ""
-
         print(f"Translation of {main_text_filename} in progress")
 
-        for i in tqdm(range(len(listed_text))):
-            translation = (
-                translation
-                + self.translator.invoke(
-                    {
-                        "language": target_language,
-                        "auxilary_text": auxilary_text,
-                        "page": listed_text[i],
-                    }
-                ).content
-            )
-
-        with open(
+        # The chunks only share the auxilary text, so they can be translated
+        # independently and put back together in their original order.
+        inputs = [
+            {
+                "language": target_language,
+                "auxilary_text": auxilary_text,
+                "page": page,
+            }
+            for page in listed_text
+        ]
+        checkpoint = chunk_journal.checkpoint("translator", inputs)
+        results = iter_chunks(
+            self.translator,
+            inputs,
+            self.max_concurrency,
+            checkpoint,
+            get_token(config),
+        )
+        # Each translated chunk reaches the disk as soon as it and the chunks
+        # before it are done; the file gets its final name at the end
+        write_chunks(
             f"files/markdowns/{main_text_filename}_{target_language}.mmd",
-            "w",
-            encoding="utf-8",
-        ) as f:
-            f.write(translation)
+            (result.content for result in results),
+        )
+        checkpoint.finish()
 
         return {"report": HumanMessage(content="Translation completed")}
 
@@ -488,25 +652,24 @@ class CitationExtractionWorkflow:
         citation_extractor_model=None,
         citation_retriever_model=None,
         citation_cleaner_model=None,
+        max_concurrency=4,
+        target_tokens=TARGET_TOKENS,
     ):
         if citation_extractor_model == None:
-            self.citation_extractor_model = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash"
-            )
+            self.citation_extractor_model = get_chat_model(cached=True)
         else:
             self.citation_extractor_model = citation_extractor_model
         if citation_retriever_model == None:
-            self.citation_retriever_model = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash"
-            )
+            self.citation_retriever_model = get_chat_model(cached=True)
         else:
             self.citation_retriever_model = citation_retriever_model
         if citation_cleaner_model == None:
-            self.citation_cleaner_model = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash"
-            )
+            self.citation_cleaner_model = get_chat_model(cached=True)
         else:
             self.citation_cleaner_model = citation_cleaner_model
+        # Number of chunks that are sent in parallel in each pass
+        self.max_concurrency = max_concurrency
+        self.target_tokens = target_tokens
 
         self.citation_extractor = (
             citation_extractor_prompt_template | self.citation_extractor_model
@@ -518,43 +681,12 @@ class CitationExtractionWorkflow:
             citation_cleaner_prompt_template | self.citation_cleaner_model
         )
 
-    def run_citation_retriever(self, state):
+    def run_citation_loader(self, state):
         main_text_filename = state["main_text_filename"].content
         auxilary_text_filename = state["auxilary_text_filename"].content
         main_text_filename = get_filename_without_extension(main_text_filename)
         auxilary_text_filename = get_filename_without_extension(auxilary_text_filename)
 
-        text_splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=0)
-        with open(
-            f"files/markdowns/{main_text_filename}.mmd", "r", encoding="utf-8"
-        ) as f:
-            text = f.read()
-
-        listed_text = text_splitter.split_text(text)
-        citations = ""
-
-        print(
-            f"Retriving full list of  citations from {main_text_filename} in progress"
-        )
-
-        for i in tqdm(range(len(listed_text))):
-            citations = (
-                citations
-                + self.citation_retriever.invoke(
-                    {"main_text": HumanMessage(content=listed_text[i])}
-                ).content
-            )
-        return {"report": HumanMessage(content=citations)}
-
-    def run_citation_extractor(self, state):
-        main_text_filename = state["main_text_filename"].content
-        extraction_type = state["extraction_type"].content
-        auxilary_text_filename = state["auxilary_text_filename"].content
-        list_of_citations = state["report"].content
-        main_text_filename = get_filename_without_extension(main_text_filename)
-        auxilary_text_filename = get_filename_without_extension(auxilary_text_filename)
-
-        text_splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=0)
         with open(
             f"files/markdowns/{main_text_filename}.mmd", "r", encoding="utf-8"
         ) as f:
@@ -571,29 +703,149 @@ class CitationExtractionWorkflow:
             )
             auxilary_text = "No"
 
-        listed_text = text_splitter.split_text(text)
-        citations = ""
+        # The references section is parsed by rules first. The LLM retriever
+        # only reads the chunks holding entries the parser could not resolve,
+        # or every chunk if the document has no recognizable section at all.
+        references = parse_references(text)
+
+        # The extractor repeats the auxilary text and the cited references in
+        # every request; the retriever writes the references of its chunk back.
+        max_tokens = chunk_budget(
+            self.target_tokens,
+            prompt_overhead(
+                citation_extractor_prompt_template, auxiliary_text=auxilary_text
+            )
+            + estimate_tokens("\n".join(entry["text"] for entry in references)),
+            output_ratio=1.0,
+        )
+        # Both passes work on the same chunks, so the file is split only once
+        chunks = split_file(f"files/markdowns/{main_text_filename}.mmd", max_tokens)
+        if references:
+            resolved = [entry for entry in references if entry["resolved"]]
+            unresolved = [entry for entry in references if not entry["resolved"]]
+            unresolved_pages = [
+                i
+                for i, chunk in enumerate(chunks)
+                if any(entry["text"][:40] in chunk for entry in unresolved)
+            ]
+            bibliography_pages = [
+                i
+                for i, chunk in enumerate(chunks)
+                if any(entry["text"][:40] in chunk for entry in references)
+            ]
+            print(
+                f"{len(resolved)} of {len(references)} references parsed without the LLM"
+            )
+        else:
+            resolved = []
+            unresolved_pages = list(range(len(chunks)))
+            bibliography_pages = []
+        return {
+            "chunks": chunks,
+            "references": resolved,
+            "unresolved_pages": unresolved_pages,
+            "bibliography_pages": bibliography_pages,
+            "auxilary_text": auxilary_text,
+            "main_text_filename": HumanMessage(content=main_text_filename),
+        }
+
+    def run_citation_retriever(self, state, config=None):
+        main_text_filename = state["main_text_filename"].content
+        listed_text = state["chunks"]
+
+        print(
+            f"Retriving full list of  citations from {main_text_filename} in progress"
+        )
+
+        pages = state["unresolved_pages"]
+        inputs = [{"main_text": HumanMessage(content=listed_text[i])} for i in pages]
+        checkpoint = chunk_journal.checkpoint("citation_retriever", inputs)
+        results = run_chunks(
+            self.citation_retriever,
+            inputs,
+            self.max_concurrency,
+            checkpoint,
+            get_token(config),
+        )
+        checkpoint.finish()
+        # Chunks outside the bibliography are answered with a fixed sentence
+        retrieved_pages = [
+            page
+            for page, result in zip(pages, results)
+            if "Not a bibliography page" not in result.content
+        ]
+        retrieved = [
+            line
+            for result in results
+            if "Not a bibliography page" not in result.content
+            for line in result.content.splitlines()
+        ]
+        # The chunks also hold the entries the parser resolved already
+        retrieved = new_entries(retrieved, state["references"])
+        citations = "\n".join(
+            [entry["text"] for entry in state["references"]] + retrieved
+        )
+        return {
+            "list_of_citations": citations,
+            "bibliography_pages": sorted(
+                set(state["bibliography_pages"]) | set(retrieved_pages)
+            ),
+            "report": HumanMessage(content=citations),
+        }
+
+    def run_citation_extractor(self, state, config=None):
+        main_text_filename = state["main_text_filename"].content
+        extraction_type = state["extraction_type"].content
+        list_of_citations = state["list_of_citations"]
+        listed_text = state["chunks"]
+        bibliography_pages = set(state["bibliography_pages"])
+        bibliography = CitationIndex(index_bibliography(list_of_citations))
+        keyed = bibliography.is_keyed()
 
         print(
             f"Extracting requested type of citations from {main_text_filename} in progress"
         )
 
-        for i in tqdm(range(len(listed_text))):
-            citations = (
-                citations
-                + self.citation_extractor.invoke(
-                    {
-                        "extraction_type": extraction_type,
-                        "main_text": listed_text[i],
-                        "auxiliary_text": auxilary_text,
-                        "list_of_citations": list_of_citations,
-                    }
-                ).content
+        # Every chunk only gets the references it cites. The bibliography itself
+        # is cut off and chunks that cite nothing are not sent at all. A chunk
+        # citing [n] labels the entries lack gets the whole list instead.
+        inputs = []
+        for i, chunk in enumerate(listed_text):
+            if i in bibliography_pages:
+                chunk = text_before_references(chunk, bibliography.entries)
+                if not chunk.strip():
+                    continue
+            if keyed and not bibliography.has_unresolved_markers(chunk):
+                cited = bibliography.cited_in(chunk)
+                if not cited:
+                    continue
+                chunk_citations = "\n".join(entry["text"] for entry in cited)
+            else:
+                chunk_citations = list_of_citations
+            inputs.append(
+                {
+                    "extraction_type": extraction_type,
+                    "main_text": chunk,
+                    "auxiliary_text": state["auxilary_text"],
+                    "list_of_citations": chunk_citations,
+                }
             )
+        print(f"{len(inputs)} of {len(listed_text)} chunks cite references")
+        checkpoint = chunk_journal.checkpoint("citation_extractor", inputs)
+        results = run_chunks(
+            self.citation_extractor,
+            inputs,
+            self.max_concurrency,
+            checkpoint,
+            get_token(config),
+        )
+        checkpoint.finish()
+        citations = "\n".join(result.content for result in results)
 
-        return {"report": HumanMessage(content=list_of_citations)}
+        return {"report": HumanMessage(content=citations)}
 
-    def run_citation_cleaner(self, state):
+    def run_citation_cleaner(self, state, config=None):
+        check_cancelled(config)
         citations = state["report"].content
         main_text_filename = state["main_text_filename"].content
         citations = self.citation_cleaner.invoke(
@@ -607,10 +859,12 @@ class CitationExtractionWorkflow:
 
     def create_workflow(self):
         workflow = StateGraph(CitationExtractorState)
-        workflow.set_entry_point("citation_retriever")
+        workflow.set_entry_point("citation_loader")
+        workflow.add_node("citation_loader", self.run_citation_loader)
         workflow.add_node("citation_retriever", self.run_citation_retriever)
         workflow.add_node("citation_extractor", self.run_citation_extractor)
         workflow.add_node("citation_cleaner", self.run_citation_cleaner)
+        workflow.add_edge("citation_loader", "citation_retriever")
         workflow.add_edge("citation_retriever", "citation_extractor")
         workflow.add_edge("citation_extractor", "citation_cleaner")
         workflow.add_edge("citation_cleaner", END)
@@ -620,12 +874,12 @@ class CitationExtractionWorkflow:
 class TakeAPeakWorkflow:
     def __init__(self, take_a_peak_model=None):
         if take_a_peak_model == None:
-            self.take_a_peak_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.take_a_peak_model = get_chat_model(cached=True)
         else:
             self.take_a_peak_model = take_a_peak_model
         self.take_a_peaker = keyword_and_summary_maker_template | self.take_a_peak_model
 
-    def run_take_a_peaker(self, state):
+    def run_take_a_peaker(self, state, config=None):
         text_filename = state["main_text_filename"].content
         text_filename = get_filename_without_extension(text_filename)
         markdown_path1 = os.path.join(r"files\markdowns", f"{text_filename}.mmd")
@@ -643,6 +897,8 @@ class TakeAPeakWorkflow:
             ) as f:
                 text = f.read()
         elif os.path.exists(pdf_path):
+            import pymupdf4llm
+
             md_text = pymupdf4llm.to_markdown(pdf_path)
             pathlib.Path(mupdf_path).write_bytes(md_text.encode())
             with open(
@@ -652,14 +908,14 @@ class TakeAPeakWorkflow:
         else:
             return {"report": "There was an error with the filename"}
 
-        text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-        text = text_splitter.split_text(text)
+        text = [chunk["text"] for chunk in chunk_text(text, max_tokens=250)]
         peak = ""
         keyword_and_summary = ""
         if len(text) == 1:
             peak = "Here is the text:/n" + text[0]
         elif 4 > len(text) > 0:
             for i in tqdm(range(len(text))):
+                check_cancelled(config)
                 keyword_and_summary = self.take_a_peaker.invoke(
                     {"text": keyword_and_summary, "page": text[i]}
                 ).content
@@ -671,6 +927,7 @@ class TakeAPeakWorkflow:
             )
         else:
             for i in tqdm(range(3)):
+                check_cancelled(config)
                 keyword_and_summary = self.take_a_peaker.invoke(
                     {"text": keyword_and_summary, "page": text[i]}
                 ).content
@@ -701,3 +958,45 @@ class TakeAPeakWorkflow:
         workflow.add_node("take_a_peaker", self.run_take_a_peaker)
         workflow.add_edge("take_a_peaker", END)
         return workflow
+
+
+class QuestionAnsweringWorkflow:
+    def __init__(self, answering_model=None, index=None, k=6):
+        if answering_model == None:
+            self.answering_model = get_chat_model(cached=True)
+        else:
+            self.answering_model = answering_model
+        if index == None:
+            # numpy comes with the index, so it is not imported with the module
+            from retrieval_index import HybridIndex
+
+            self.index = HybridIndex(embedder=get_embeddings())
+        else:
+            self.index = index
+        self.k = k
+        self.answerer = question_answering_prompt_template | self.answering_model
+
+    def run_answerer(self, state):
+        question = state["question"].content
+        self.index.update()
+        hits = self.index.search(question, k=self.k)
+        if not hits:
+            return {"report": HumanMessage(content="The library has nothing on this.")}
+        excerpts = []
+        for hit in hits:
+            page = f", page {hit['page']}" if hit["page"] != None else ""
+            excerpts.append(f"[{hit['document']}{page}]\n{hit['text']}")
+        answer = self.answerer.invoke(
+            {"question": question, "context": "\n\n".join(excerpts)}
+        ).content
+        return {"report": HumanMessage(content=answer)}
+
+    def create_workflow(self):
+        """
+        Create a workflow that answers a question from the indexed markdowns.
+        """
+        workflow = StateGraph(QuestionAnsweringState)
+        workflow.set_entry_point("answerer")
+        workflow.add_node("answerer", self.run_answerer)
+        workflow.add_edge("answerer", END)
+        return workflow
@@ -0,0 +1,73 @@
+import json, os, subprocess, sys
+
+
+### Startup check for the lazy imports of the tools. A fresh interpreter
+### imports workflows_as_tools and registers the tools, the way the Streamlit
+### app starts, and reports how long that took. None of the heavy packages may
+### be loaded by then: they belong to the tools that need them and are imported
+### on their first call. Run `python startup_benchmark.py`; it exits with an
+### error if a heavy package was imported at startup or the startup took longer
+### than STARTUP_BUDGET seconds (5 by default).
+HEAVY_MODULES = [
+    "torch",
+    "sentence_transformers",
+    "numpy",
+    "pymupdf",
+    "pymupdf4llm",
+    "httpx",
+    "langchain_google_genai",
+    "google.generativeai",
+]
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "5"))
+
+COLD_START = """
+import json, sys, time
+start = time.perf_counter()
+import workflows_as_tools
+imported = time.perf_counter()
+workflows_as_tools.create_tools()
+registered = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "create_tools": registered - imported,
+    "modules": sorted(sys.modules),
+}))
+"""
+
+
+def cold_start():
+    """Imports the tools in a new interpreter and returns what it measured."""
+    output = subprocess.run(
+        [sys.executable, "-c", COLD_START],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    result = cold_start()
+    total = result["import"] + result["create_tools"]
+    print(f"import workflows_as_tools: {result['import']:.2f}s")
+    print(f"create_tools():            {result['create_tools']:.2f}s")
+    failures = []
+    loaded = [
+        module
+        for module in HEAVY_MODULES
+        if any(
+            name == module or name.startswith(module + ".")
+            for name in result["modules"]
+        )
+    ]
+    if loaded:
+        failures.append(f"imported at startup: {', '.join(loaded)}")
+    if total > STARTUP_BUDGET:
+        failures.append(f"startup took {total:.2f}s, over {STARTUP_BUDGET:.2f}s")
+    if failures:
+        sys.exit("\n".join(failures))
+    print(f"None of {', '.join(HEAVY_MODULES)} is imported at startup")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,13 @@
-import os
+import os, uuid
 
 os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
 from simple_workflows import *
 from simple_tools import *
 from workflows_as_tools import *
 import streamlit as st
-from langchain_core.messages import HumanMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.messages import AIMessage, HumanMessage
+from model_pool import get_chat_model
+from job_queue import JobManager
 from dotenv import load_dotenv
 from langchain_core.messages import ToolMessage
 from simple_tools import *
@@ -14,12 +15,59 @@ from streamlit_pdf_viewer import pdf_viewer
 from dotenv import load_dotenv
 
 
+@st.cache_resource
+def load_tools():
+    # Built once per server process instead of on every rerun
+    return create_tools()
+
+
+@st.cache_resource
+def load_job_manager():
+    # One pool of workers for every session of the server
+    return JobManager()
+
+
+@st.experimental_fragment(run_every=2)
+def show_jobs():
+    """The jobs of this session, polled every two seconds."""
+    jobs = load_job_manager().jobs(owner=st.session_state.session_id)
+    finished = False
+    for job in reversed(jobs):
+        st.write(f"**#{job.id} {job.name}**: {job.status}")
+        if job.total:
+            st.progress(job.done / job.total, text=f"{job.done}/{job.total} chunks")
+        if not job.finished_running:
+            if job.cancel_requested:
+                st.caption("Stopping...")
+            elif st.button("Cancel", key=f"cancel_{job.id}"):
+                load_job_manager().cancel(job.id)
+            partial = job.partial_output()
+            if partial:
+                with st.expander("Output so far"):
+                    st.text(partial[-3000:])
+        elif job.id not in st.session_state.reported_jobs:
+            st.session_state.reported_jobs.add(job.id)
+            if job.status == "done":
+                report = f"Job #{job.id} ({job.name}) finished: {job.result}"
+            elif job.status == "failed":
+                report = f"Job #{job.id} ({job.name}) failed: {job.error}"
+            else:
+                report = f"Job #{job.id} ({job.name}) was cancelled"
+            st.session_state.messages.append({"role": "tool", "content": report})
+            # The supervisor goes on from the result of the job
+            st.session_state.chat_history.append(HumanMessage(content=report))
+            st.session_state.awaiting_response = True
+            finished = True
+    if finished:
+        st.rerun()
+
+
 def main():
     def invoke(state, container):
-        supervisor_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
-        tools = create_tools()
+        supervisor_model = get_chat_model()
+        tools = load_tools()
+        tools_by_name = {tool.name: tool for tool in tools}
         supervisor = supervisor_prompt_template | supervisor_model.bind_tools(tools)
-        tool_executor = ToolExecutor(tools)
         folder_structure = get_folder_structure()
         while True:
             workflow_state = {
@@ -29,54 +77,71 @@ def main():
             action = supervisor.invoke(workflow_state)
             message = st.session_state.messages[-1]
             if "tool_calls" in action.additional_kwargs:
+                st.session_state.chat_history.append(action)
+                started = []
                 with container:
                     with st.chat_message(message["role"], avatar=":material/build:"):
-                        st.write(
-                            "I am currently applying: " + action.tool_calls[-1]["name"]
-                        )
-                        st.write(
-                            "Please be patient, some of the tools take time. Check your terminal for progress."
-                        )
-                        st.session_state.messages.append(
-                            {
-                                "role": "tool",
-                                "content": "Please be patient, some of the tools take time. Check your terminal for progress.",
-                            }
-                        )
-                        st.session_state.messages.append(
-                            {
-                                "role": "tool",
-                                "content": "I am currently using the following tool: "
-                                + action.tool_calls[-1]["name"],
-                            }
-                        )
-                        st.session_state.chat_history.append(action)
-                        tool_call = action.tool_calls[-1]
-                        st.write(tool_call["name"], tool_call["args"])
-                        st.session_state.messages.append(
-                            {
-                                "role": "tool",
-                                "content": str(tool_call["name"])
-                                + str(tool_call["args"]),
-                            }
-                        )
-                        Invocation = ToolInvocation(
-                            tool=tool_call["name"], tool_input=tool_call["args"]
-                        )
-                        try:
-                            response = tool_executor.invoke(Invocation)
-                        except Exception as e:
-                            response = str(e)
-                        if response is None:
-                            response = "Something went wrong"
-                        st.write(response)
-                        st.session_state.messages.append(
-                            {"role": "tool", "content": str(response)}
-                        )
-                        response = ToolMessage(
-                            content=response, tool_call_id=tool_call["id"]
-                        )
-                        st.session_state.chat_history.append(response)
+                        for tool_call in action.tool_calls:
+                            st.write("I am currently applying: " + tool_call["name"])
+                            st.session_state.messages.append(
+                                {
+                                    "role": "tool",
+                                    "content": "I am currently using the following tool: "
+                                    + tool_call["name"],
+                                }
+                            )
+                            st.write(tool_call["name"], tool_call["args"])
+                            st.session_state.messages.append(
+                                {
+                                    "role": "tool",
+                                    "content": str(tool_call["name"])
+                                    + str(tool_call["args"]),
+                                }
+                            )
+                            if tool_call["name"] in tools_by_name:
+                                job = load_job_manager().submit(
+                                    tool_call["name"],
+                                    tools_by_name[tool_call["name"]].invoke,
+                                    tool_call["args"],
+                                    owner=st.session_state.session_id,
+                                )
+                                started.append(job)
+                                response = (
+                                    f"Started as background job #{job.id}. Its "
+                                    "result is reported when it is done."
+                                )
+                            else:
+                                response = (
+                                    f"There is no tool called {tool_call['name']}"
+                                )
+                            st.write(response)
+                            st.session_state.messages.append(
+                                {"role": "tool", "content": response}
+                            )
+                            # Every tool call is answered at once, so the chat
+                            # goes on while the jobs run
+                            st.session_state.chat_history.append(
+                                ToolMessage(
+                                    content=response, tool_call_id=tool_call["id"]
+                                )
+                            )
+                if started:
+                    # The supervisor goes on from the reports of the jobs, never
+                    # from an output that does not exist yet
+                    response = (
+                        "I will go on once "
+                        + ", ".join(f"#{job.id} {job.name}" for job in started)
+                        + (" is" if len(started) == 1 else " are")
+                        + " done. Follow the progress in the Jobs panel."
+                    )
+                    with container:
+                        with st.chat_message("assistant"):
+                            st.write(response)
+                    st.session_state.chat_history.append(AIMessage(content=response))
+                    st.session_state.messages.append(
+                        {"role": "assistant", "content": response}
+                    )
+                    break
 
             if "tool_calls" not in action.additional_kwargs:
                 with container:
@@ -124,6 +189,10 @@ def main():
         st.session_state.disable_input = False
     if "st_file" not in st.session_state:
         st.session_state.st_file = None
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    if "reported_jobs" not in st.session_state:
+        st.session_state.reported_jobs = set()
 
     # Create a sidebar widget to display the folder structure
     left_sidebar, main_content, right_sidebar = st.columns(
@@ -182,6 +251,8 @@ def main():
                     f.write(uploaded_file.getbuffer())
                 st.success(f"File '{uploaded_file.name}' uploaded successfully!")
         st.image("files/images/robot2.png", use_column_width=True)
+        st.subheader("Jobs")
+        show_jobs()
 
     with right_sidebar:
         right_container = st.container(height=755)
@@ -240,6 +311,7 @@ def main():
                         with st.spinner("Thinking...this may take a while"):
                             st.session_state.awaiting_response = False
                             invoke(st.session_state, chat_container)
+                            # The jobs it started run on; the chat stays open
                             st.session_state.disable_input = False
                 st.rerun()
     else:
@@ -0,0 +1,188 @@
+import os, shutil, tempfile, threading, unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from arxiv_batch import ArxivBatchRetriever, parse_bibliography
+from arxiv_index import ArxivIndex
+
+
+### Tests of the batch retriever against a local stub of the arXiv API and PDF
+### server. Run `python -m unittest test_arxiv_batch`.
+TITLE = "Attention Is All You Need"
+PDF = b"%PDF-1.4\n" + b"0" * 100_000
+FEED = f"""<feed xmlns="http://www.w3.org/2005/Atom">
+<entry>
+<id>http://arxiv.org/abs/1706.03762v7</id>
+<title>{TITLE}</title>
+<summary>The dominant sequence transduction models...</summary>
+<author><name>Ashish Vaswani</name></author>
+</entry>
+</feed>"""
+
+
+class StubArxiv(BaseHTTPRequestHandler):
+    api_requests = 0
+    # Set by the tests: "ok", "truncated" to hang up halfway through the PDF,
+    # or "html" to answer with an error page
+    mode = "ok"
+    pdf_requests = 0
+    ranges = []
+
+    def do_HEAD(self):
+        if self.path == "/pdf/1706.03762.pdf":
+            self.send_response(200)
+            self.send_header("Content-Type", "application/pdf")
+            self.send_header("Content-Length", str(len(PDF)))
+            self.send_header("ETag", '"v7"')
+            self.end_headers()
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        if self.path.startswith("/api"):
+            StubArxiv.api_requests += 1
+            body = FEED.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/atom+xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/pdf/1706.03762.pdf" and self.mode == "html":
+            body = b"<html>Rate exceeded</html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/pdf/1706.03762.pdf":
+            StubArxiv.pdf_requests += 1
+            StubArxiv.ranges.append(self.headers.get("Range"))
+            start = 0
+            if self.headers.get("Range"):
+                start = int(self.headers["Range"][len("bytes=") : -1])
+                self.send_response(206)
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "application/pdf")
+            self.send_header("Content-Length", str(len(PDF) - start))
+            self.end_headers()
+            if self.mode == "truncated":
+                self.wfile.write(PDF[start : len(PDF) // 2])
+                self.close_connection = True
+            else:
+                self.wfile.write(PDF[start:])
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class ParseBibliographyTest(unittest.TestCase):
+    def test_numbered_entries(self):
+        self.assertEqual(
+            parse_bibliography("1. A. One, First paper. 2. B. Two, Second paper."),
+            ["A. One, First paper.", "B. Two, Second paper."],
+        )
+
+    def test_one_entry_per_line(self):
+        self.assertEqual(
+            parse_bibliography("[1] A. One, First paper\n[2] B. Two, Second paper"),
+            ["A. One, First paper", "B. Two, Second paper"],
+        )
+
+    def test_volume_numbers_are_no_labels(self):
+        entry = "J. Smith, Results on graphs, vol. 12. 2019, pp. 1-3"
+        self.assertEqual(parse_bibliography(entry), [entry])
+        entry = "Smith J. Deep learning in 3D. Nature 2. 2020"
+        self.assertEqual(parse_bibliography(entry), [entry])
+
+    def test_years_are_no_labels(self):
+        self.assertEqual(
+            parse_bibliography("1. A. One, Graphs, 2020. 2. B. Two, Trees, 2021."),
+            ["A. One, Graphs, 2020.", "B. Two, Trees, 2021."],
+        )
+
+
+class ArxivBatchDownloadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubArxiv)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        StubArxiv.api_requests = 0
+        StubArxiv.mode = "ok"
+        StubArxiv.pdf_requests = 0
+        StubArxiv.ranges = []
+        self.state_folder = os.path.join(self.folder, "downloads")
+        self.retriever = ArxivBatchRetriever(
+            api_url=f"{self.url}/api/query",
+            pdf_url=f"{self.url}/pdf",
+            folder=self.folder,
+            api_interval=0,
+            pdf_interval=0,
+            index=ArxivIndex(os.path.join(self.folder, "index.sqlite")),
+            state_folder=self.state_folder,
+        )
+        self.save_path = os.path.join(self.folder, "Attention_Is_All_You.pdf")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_downloads_the_whole_pdf(self):
+        report = self.retriever.retrieve(f'1. Vaswani et al., "{TITLE}", 2017')
+        self.assertIn("sucessfully been downloaded", report)
+        with open(self.save_path, "rb") as f:
+            self.assertEqual(f.read(), PDF)
+        self.assertFalse(
+            any(name.endswith(".part") for name in os.listdir(self.state_folder))
+        )
+
+    def test_a_title_without_match_is_reported(self):
+        report = self.retriever.retrieve('"A completely different paper title"')
+        self.assertIn("could not be retrieved", report)
+        self.assertEqual(StubArxiv.pdf_requests, 0)
+
+    def test_skips_a_pdf_that_is_already_there(self):
+        with open(self.save_path, "wb") as f:
+            f.write(b"%PDF- kept")
+        report = self.retriever.retrieve(f'"{TITLE}"')
+        self.assertIn("is already in", report)
+        self.assertEqual(StubArxiv.pdf_requests, 0)
+        with open(self.save_path, "rb") as f:
+            self.assertEqual(f.read(), b"%PDF- kept")
+
+    def test_a_broken_download_is_resumed(self):
+        StubArxiv.mode = "truncated"
+        report = self.retriever.retrieve(f'"{TITLE}"')
+        self.assertIn("could not be retrieved", report)
+        self.assertFalse(os.path.exists(self.save_path))
+        # The partial file waits in the state folder, not next to the PDFs
+        self.assertFalse(
+            any(name.endswith(".part") for name in os.listdir(self.folder))
+        )
+        self.assertTrue(
+            any(name.endswith(".part") for name in os.listdir(self.state_folder))
+        )
+        # The next run asks for the rest only
+        StubArxiv.mode = "ok"
+        self.retriever.retrieve(f'"{TITLE}"')
+        with open(self.save_path, "rb") as f:
+            self.assertEqual(f.read(), PDF)
+        self.assertEqual(StubArxiv.ranges[-1], f"bytes={len(PDF) // 2}-")
+
+    def test_an_error_page_is_not_saved_as_pdf(self):
+        StubArxiv.mode = "html"
+        report = self.retriever.retrieve(f'"{TITLE}"')
+        self.assertIn("incomplete or corrupted", report)
+        self.assertFalse(os.path.exists(self.save_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import os, shutil, tempfile, threading, time, unittest
+from pdf_conversion import PageCache, read_page_offsets
+from vision_conversion import StubTranscriber, convert_pdf_with_vision, transcribe_pages
+
+
+### Converts a generated PDF with StubTranscriber, no model involved. Needs
+### PyMuPDF. Run `python -m unittest test_vision_conversion`.
+PAGES = 6
+
+
+class FlakyTranscriber(StubTranscriber):
+    """Finishes the later pages first, fails the pages in `broken` every time
+    and the pages in `flaky` the first time only."""
+
+    def __init__(self, broken=(), flaky=()):
+        super().__init__()
+        self.broken = set(broken)
+        self.flaky = set(flaky)
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def transcribe(self, image, page):
+        with self._lock:
+            self.calls[page] = self.calls.get(page, 0) + 1
+            calls = self.calls[page]
+        if page in self.broken or (page in self.flaky and calls == 1):
+            raise RuntimeError(f"page {page + 1} is unreadable")
+        time.sleep(0.02 * (PAGES - page))
+        return super().transcribe(image, page)
+
+
+class ConvertWithVisionTest(unittest.TestCase):
+    def setUp(self):
+        import pymupdf
+
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+        os.makedirs(os.path.join("files", "pdfs"))
+        os.makedirs(os.path.join("files", "markdowns"))
+        with pymupdf.open() as document:
+            for page in range(PAGES):
+                document.new_page().insert_text((72, 72), f"This is page {page + 1}")
+            document.save(os.path.join("files", "pdfs", "paper.pdf"))
+        self.page_cache = PageCache(os.path.join(self.folder, "page_cache"))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def read_pages(self):
+        with open(os.path.join("files", "markdowns", "paper.mmd"), "rb") as f:
+            text = f.read()
+        offsets = read_page_offsets("paper")
+        return [text[start:end].decode("utf-8") for start, end in offsets]
+
+    def test_pages_come_back_in_order(self):
+        failed = convert_pdf_with_vision(
+            "paper",
+            transcriber=FlakyTranscriber(broken=[2]),
+            render_workers=2,
+            page_cache=self.page_cache,
+        )
+        self.assertEqual(failed, [3])
+        pages = self.read_pages()
+        self.assertEqual(len(pages), PAGES)
+        for page, content in enumerate(pages):
+            if page == 2:
+                self.assertEqual(content, "")
+            else:
+                self.assertTrue(content.startswith(f"Page {page + 1} ("), content)
+
+    def test_a_failed_page_is_retried(self):
+        transcriber = FlakyTranscriber(flaky=[0], broken=[1])
+        texts = transcribe_pages(
+            transcriber,
+            [(page, b"png") for page in range(3)],
+            page_retries=2,
+            retry_delay=0.01,
+        )
+        self.assertEqual(texts[0], "Page 1 (3 bytes)")
+        self.assertEqual(transcriber.calls[0], 2)
+        self.assertIsNone(texts[1])
+        self.assertEqual(transcriber.calls[1], 3)
+        self.assertEqual(texts[2], "Page 3 (3 bytes)")
+
+
+if __name__ == "__main__":
+    unittest.main()
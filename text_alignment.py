@@ -0,0 +1,51 @@
+import numpy as np
+
+
+### Pairs the chunks of two OCR outputs of the same PDF. Both texts follow the
+### pages in the same order, so a main chunk is only compared with the
+### supporting chunks that sit around the same relative position. The memory
+### needed is batch_size x (window of supporting chunks), never the full matrix.
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def align_chunks(main_vectors, supporting_vectors, k=2, window=None, batch_size=256):
+    """For every main chunk returns the indices of the k most similar supporting
+    chunks within a positional window, sorted by position. The window is
+    re-centred after every batch on the drift of the matches found so far."""
+    main_vectors = _normalize(main_vectors)
+    supporting_vectors = _normalize(supporting_vectors)
+    n, m = len(main_vectors), len(supporting_vectors)
+    if n == 0 or m == 0:
+        return [[] for _ in range(n)]
+    k = min(k, m)
+    if window == None:
+        window = max(2 * k, m // 20)
+    scale = (m - 1) / max(n - 1, 1)
+    drift = 0
+    pairing = []
+    for start in range(0, n, batch_size):
+        rows = np.arange(start, min(start + batch_size, n))
+        expected = np.rint(rows * scale).astype(int) + drift
+        low = np.clip(expected - window, 0, m - 1)
+        high = np.clip(expected + window, 0, m - 1) + 1
+        span_start, span_end = int(low.min()), int(high.max())
+        similarities = main_vectors[rows] @ supporting_vectors[span_start:span_end].T
+        # Mask the supporting chunks that fall outside the window of each row
+        columns = np.arange(span_start, span_end)
+        outside = (columns[None, :] < low[:, None]) | (columns[None, :] >= high[:, None])
+        similarities[outside] = -np.inf
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        for row, candidates in enumerate(top):
+            candidates = [
+                int(c) + span_start
+                for c in candidates
+                if np.isfinite(similarities[row, c])
+            ]
+            pairing.append(sorted(candidates))
+        best = span_start + similarities.argmax(axis=1)
+        drift = int(np.median(best - np.rint(rows * scale)))
+    return pairing
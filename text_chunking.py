@@ -0,0 +1,242 @@
+import hashlib, json, os, re, threading
+
+
+### Markdown/LaTeX aware chunking shared by all workflows. A chunk only ends
+### where the text allows it: before a heading, at the start or end of a proof,
+### at a paragraph break, at a line end and, as a last resort, after a
+### sentence. Display math and LaTeX environments are never cut. The chunks
+### cover the text exactly, so "".join(chunks) gives the file back.
+###
+### The chunk boundaries of a file are computed once and kept in
+### files/cache/chunks as byte offsets, keyed by the hash of the file content.
+CHUNK_CACHE_FOLDER = os.path.join("files", "cache", "chunks")
+# Bump when the boundaries change, so old cache entries are not reused
+CHUNKER_VERSION = "1"
+CHARS_PER_TOKEN = 4
+# What a single gemini-1.5-flash request can take in and give back
+CONTEXT_TOKENS = 1_000_000
+OUTPUT_TOKENS = 8192
+# What a single text-embedding-004 input can hold
+EMBEDDING_INPUT_TOKENS = 2048
+# Default size of a whole request (prompt, context and chunk) for the workflows
+TARGET_TOKENS = 16_000
+MIN_CHUNK_TOKENS = 500
+PROTECTED = re.compile(
+    r"\\\[.*?\\\]|\$\$.*?\$\$|\\begin\{(equation|align|gather|multline|eqnarray|array|tabular|table|figure)(\*?)\}.*?\\end\{\1\2\}",
+    re.DOTALL,
+)
+HEADING = re.compile(r"^#{1,6}\s", re.MULTILINE)
+PROOF_START = re.compile(
+    r"^[ \t]*(?:[_*]{1,2})?(?:Proof|Preuve|D[ée]monstration|Beweis)\b|\\begin\{proof\}",
+    re.MULTILINE | re.IGNORECASE,
+)
+PROOF_END = re.compile(r"\\end\{proof\}|\\square|\\blacksquare|\\qed|∎|□")
+# A new statement also closes a proof whose end is not marked
+STATEMENT_START = re.compile(
+    r"^[ \t]*(?:[_*]{1,2})?(?:Theorem|Th[ée]or[èe]me|Lemma|Lemme|Proposition|Corollary|Corollaire|Definition|D[ée]finition|Remark|Remarque)\b",
+    re.MULTILINE | re.IGNORECASE,
+)
+PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n\s*")
+LINE_END = re.compile(r"\n")
+SENTENCE_END = re.compile(r"[.!?;:]\s+")
+
+
+def estimate_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def prompt_overhead(prompt, **values):
+    """Estimated tokens of a prompt template filled with the given values and
+    with every other variable left empty."""
+    values = {name: values.get(name, "") for name in prompt.input_variables}
+    return estimate_tokens(prompt.format(**values))
+
+
+def chunk_budget(target_tokens=TARGET_TOKENS, overhead_tokens=0, output_ratio=0.0):
+    """Tokens of text a chunk may hold so that the whole request stays within
+    target_tokens. output_ratio is the size of the answer relative to the
+    chunk (about 1 for rewriting, more for translations, 0 for a short
+    verdict); the answer has to fit in the output limit of the model with a
+    quarter to spare."""
+    budget = min(target_tokens, CONTEXT_TOKENS) - overhead_tokens
+    if output_ratio > 0:
+        budget = min(budget, int(OUTPUT_TOKENS * 0.75 / output_ratio))
+    return max(MIN_CHUNK_TOKENS, budget)
+
+
+def protected_spans(text):
+    return [(match.start(), match.end()) for match in PROTECTED.finditer(text)]
+
+
+def proof_spans(text):
+    """Returns (start, end) of every proof: from its opening marker to its
+    closing marker, or to the next heading, statement or proof if the end of
+    the proof is not marked."""
+    spans = []
+    position = 0
+    while True:
+        start = PROOF_START.search(text, position)
+        if start is None:
+            return spans
+        stop = len(text)
+        end = PROOF_END.search(text, start.end())
+        if end:
+            stop = end.end()
+        for pattern in (HEADING, STATEMENT_START, PROOF_START):
+            following = pattern.search(text, start.end())
+            if following and following.start() < stop:
+                stop = following.start()
+        spans.append((start.start(), stop))
+        position = max(stop, start.end())
+
+
+def has_proof_markers(text):
+    return PROOF_START.search(text) is not None
+
+
+def boundaries(text):
+    """Returns {position: priority} of the places where a chunk may end."""
+    candidates = {}
+
+    def add(position, priority):
+        if 0 < position < len(text):
+            candidates[position] = max(priority, candidates.get(position, 0))
+
+    for match in SENTENCE_END.finditer(text):
+        add(match.end(), 1)
+    for match in LINE_END.finditer(text):
+        add(match.end(), 2)
+    for match in PARAGRAPH_BREAK.finditer(text):
+        add(match.end(), 3)
+    for start, end in proof_spans(text):
+        add(text.rfind("\n", 0, start) + 1, 4)
+        line_end = text.find("\n", end)
+        add(len(text) if line_end == -1 else line_end + 1, 4)
+    for match in HEADING.finditer(text):
+        add(match.start(), 5)
+    for start, end in protected_spans(text):
+        for position in range(start + 1, end):
+            candidates.pop(position, None)
+    return candidates
+
+
+def chunk_offsets(text, max_tokens=500):
+    """Splits the text into (start, end) character ranges of at most
+    max_tokens estimated tokens. Within the second half of the budget the
+    strongest boundary wins, so chunks end before headings and proofs rather
+    than in the middle of a paragraph. A single protected block longer than
+    the budget becomes a chunk of its own."""
+    max_chars = max(1, max_tokens * CHARS_PER_TOKEN)
+    candidates = sorted(boundaries(text).items())
+    offsets = []
+    start = 0
+    index = 0
+    while start < len(text):
+        if len(text) - start <= max_chars:
+            offsets.append((start, len(text)))
+            break
+        while index < len(candidates) and candidates[index][0] <= start:
+            index += 1
+        best = None
+        scan = index
+        while scan < len(candidates) and candidates[scan][0] <= start + max_chars:
+            position, priority = candidates[scan]
+            if position >= start + max_chars // 2 and (
+                best is None or priority >= best[1]
+            ):
+                best = (position, priority)
+            scan += 1
+        if best is None and scan > index:
+            # Nothing in the second half: take the last boundary that fits
+            best = candidates[scan - 1]
+        if best is None:
+            # No boundary at all before the budget runs out (a long formula)
+            best = candidates[scan] if scan < len(candidates) else (len(text), 0)
+        offsets.append((start, best[0]))
+        start = best[0]
+    return offsets
+
+
+def chunk_text(text, max_tokens=500):
+    """Splits the text into chunks. Every chunk is a dict with its text, its
+    byte offsets in the UTF-8 encoded text and whether it starts inside a
+    proof that began in an earlier chunk."""
+    proofs = proof_spans(text)
+    chunks = []
+    byte_position = 0
+    for start, end in chunk_offsets(text, max_tokens):
+        piece = text[start:end]
+        size = len(piece.encode("utf-8"))
+        chunks.append(
+            {
+                "text": piece,
+                "start": byte_position,
+                "end": byte_position + size,
+                "continues_proof": any(
+                    proof_start < start < proof_end for proof_start, proof_end in proofs
+                ),
+            }
+        )
+        byte_position += size
+    return chunks
+
+
+class ChunkCache:
+    def __init__(self, folder=CHUNK_CACHE_FOLDER):
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._memory = {}
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    def chunks(self, data, max_tokens):
+        """Returns the chunks of the UTF-8 encoded data, computing and storing
+        the boundaries only the first time."""
+        key = hashlib.sha256(
+            f"{CHUNKER_VERSION}\0{max_tokens}\0".encode("utf-8") + data
+        ).hexdigest()
+        with self._lock:
+            offsets = self._memory.get(key)
+        if offsets == None and os.path.exists(self._path(key)):
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                offsets = json.load(f)
+        if offsets == None:
+            offsets = [
+                [chunk["start"], chunk["end"], chunk["continues_proof"]]
+                for chunk in chunk_text(data.decode("utf-8"), max_tokens)
+            ]
+            os.makedirs(self.folder, exist_ok=True)
+            temp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(offsets, f)
+            os.replace(temp_path, self._path(key))
+        with self._lock:
+            self._memory[key] = offsets
+        return [
+            {
+                "text": data[start:end].decode("utf-8"),
+                "start": start,
+                "end": end,
+                "continues_proof": continues_proof,
+            }
+            for start, end, continues_proof in offsets
+        ]
+
+
+chunk_cache = ChunkCache()
+
+
+def chunk_file(path, max_tokens=500):
+    """Chunks of a markdown file, from the cache when the file is unchanged."""
+    with open(path, "rb") as f:
+        data = f.read()
+    chunks = chunk_cache.chunks(data, max_tokens)
+    print(
+        f"{os.path.basename(path)}: {len(chunks)} chunks of up to {max_tokens} tokens"
+    )
+    return chunks
+
+
+def split_file(path, max_tokens=500):
+    return [chunk["text"] for chunk in chunk_file(path, max_tokens)]
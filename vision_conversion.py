@@ -0,0 +1,206 @@
+import base64, os, random, time
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    FIRST_COMPLETED,
+    wait,
+)
+from tqdm import tqdm
+from progress import report_progress
+from cancellation import current_token
+from pdf_conversion import (
+    PDF_FOLDER,
+    MUPDF_WORKERS,
+    PageCache,
+    page_hashes,
+    page_ranges,
+    write_markdown,
+)
+
+
+### Second conversion engine: every page of the PDF is rendered to an image
+### (PyMuPDF, over page ranges in a process pool) and transcribed by a vision
+### model, with a bounded number of page requests in flight. Pages are sent as
+### soon as their range is rendered and a failed page is retried on its own
+### after a jittered backoff, so a paper converts in about the time of its
+### slowest page and needs no GPU. The pages are put back in order into the
+### same {name}.mmd layout as Nougat's, page map included, and go through the
+### same page cache.
+###
+### The transcriber is anything with a transcribe(image, page) method that
+### returns the markdown of a PNG image; StubTranscriber stands in for the
+### model in tests and benchmarks.
+VISION_IN_FLIGHT = int(os.getenv("VISION_IN_FLIGHT", "8"))
+VISION_DPI = int(os.getenv("VISION_DPI", "150"))
+
+
+def render_pages(pdf_path, pages, dpi=VISION_DPI):
+    import pymupdf
+
+    images = []
+    with pymupdf.open(pdf_path) as document:
+        for page in pages:
+            images.append(document[page].get_pixmap(dpi=dpi).tobytes("png"))
+    return images
+
+
+def page_message(image, page):
+    from langchain_core.messages import HumanMessage
+
+    encoded = base64.b64encode(image).decode("ascii")
+    return HumanMessage(
+        content=[
+            {"type": "text", "text": f"Page {page + 1}:"},
+            {"type": "image_url", "image_url": f"data:image/png;base64,{encoded}"},
+        ]
+    )
+
+
+class VisionTranscriber:
+    def __init__(self, model=None):
+        if model == None:
+            from model_pool import get_chat_model
+
+            self.model = get_chat_model(temperature=0)
+        else:
+            self.model = model
+        self.name = f"vision-{getattr(self.model, 'model', 'model')}"
+
+    def transcribe(self, image, page):
+        from langchain_core.messages import SystemMessage
+        from prompts import vision_transcriber_system_template
+
+        messages = [
+            SystemMessage(content=vision_transcriber_system_template),
+            page_message(image, page),
+        ]
+        return self.model.invoke(messages).content
+
+
+class StubTranscriber:
+    """Answers every page with a placeholder after `delay` seconds."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.name = "vision-stub"
+
+    def transcribe(self, image, page):
+        time.sleep(self.delay)
+        return f"Page {page + 1} ({len(image)} bytes)"
+
+
+def transcribe_pages(
+    transcriber,
+    rendered,
+    max_in_flight=VISION_IN_FLIGHT,
+    page_retries=2,
+    retry_delay=1.0,
+    progress=None,
+):
+    """Transcribes the (page, image) pairs that `rendered` yields, keeping at
+    most max_in_flight requests open. Returns {page: text}; a page that still
+    fails after page_retries retries comes back as None. The n-th retry of a
+    page waits a random delay up to retry_delay * 2**(n - 1) seconds. A
+    cancelled run stops sending pages and raises RunCancelled."""
+    token = current_token.get()
+    texts = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        pending = {}
+        attempts = {}
+
+        def transcribe(page, image, delay):
+            if delay > 0:
+                if token == None:
+                    time.sleep(delay)
+                elif token.wait(delay):
+                    token.check()
+            return transcriber.transcribe(image, page)
+
+        def submit(page, image):
+            attempts[page] = attempts.get(page, 0) + 1
+            delay = 0.0
+            if attempts[page] > 1:
+                # Full jitter, so the retries of a burst of failures spread out
+                delay = random.uniform(0, retry_delay * 2 ** (attempts[page] - 2))
+            pending[executor.submit(transcribe, page, image, delay)] = (page, image)
+
+        rendered = iter(rendered)
+        exhausted = False
+        while not exhausted or pending:
+            if token != None:
+                token.check()
+            # Top up with freshly rendered pages before waiting
+            while not exhausted and len(pending) < max_in_flight:
+                try:
+                    page, image = next(rendered)
+                except StopIteration:
+                    exhausted = True
+                    break
+                submit(page, image)
+            if not pending:
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                page, image = pending.pop(future)
+                try:
+                    texts[page] = future.result()
+                except Exception as e:
+                    if attempts[page] > page_retries:
+                        print(f"Page {page + 1} failed: {e}")
+                        texts[page] = None
+                    else:
+                        submit(page, image)
+                        continue
+                if progress != None:
+                    progress.update(1)
+                    report_progress(progress.n, progress.total)
+    return texts
+
+
+def convert_pdf_with_vision(
+    pdf_name,
+    transcriber=None,
+    render_workers=MUPDF_WORKERS,
+    max_in_flight=VISION_IN_FLIGHT,
+    page_cache=None,
+):
+    """Converts files/pdfs/{pdf_name}.pdf into files/markdowns/{pdf_name}.mmd
+    with a vision model. Returns the numbers of the pages that failed."""
+    if transcriber == None:
+        transcriber = VisionTranscriber()
+    if page_cache == None:
+        page_cache = PageCache()
+    pdf_path = os.path.join(PDF_FOLDER, f"{pdf_name}.pdf")
+    hashes = page_hashes(pdf_path)
+    pages = [page_cache.get(transcriber.name, h) for h in hashes]
+    missing = [page for page, text in enumerate(pages) if text is None]
+    print(f"{len(hashes)} pages: {len(missing)} new for {transcriber.name}")
+
+    ranges = page_ranges(missing, render_workers)
+    with ProcessPoolExecutor(max_workers=max(1, len(ranges))) as executor:
+        futures = [
+            executor.submit(render_pages, pdf_path, page_range)
+            for page_range in ranges
+        ]
+
+        def rendered():
+            # The ranges come back in order; the first one is usually ready
+            # long before the requests for it are done
+            for page_range, future in zip(ranges, futures):
+                yield from zip(page_range, future.result())
+
+        with tqdm(total=len(missing)) as progress:
+            texts = transcribe_pages(
+                transcriber, rendered(), max_in_flight, progress=progress
+            )
+
+    failed = []
+    for page, text in texts.items():
+        if text is None:
+            pages[page] = ""
+            failed.append(page + 1)
+        else:
+            pages[page] = text
+            page_cache.put(transcriber.name, hashes[page], text)
+    write_markdown(pdf_name, pages)
+    return sorted(failed)
@@ -1,9 +1,17 @@
+import threading
 from prompts import *
 from langchain_core.tools import tool, StructuredTool
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from model_pool import get_chat_model, get_embeddings
 from langchain_core.messages import HumanMessage
 from simple_workflows import *
 from langchain.pydantic_v1 import BaseModel, Field
+from cancellation import (
+    TOOL_TIMEOUT,
+    CancellationToken,
+    RunCancelled,
+    cancellation_scope,
+    current_token,
+)
 
 
 ### This file contains complex tools, which means that each tool is a workflow
@@ -46,23 +54,55 @@ class TakeAPeakInput(BaseModel):
     main_text_filename: str = Field(description="The main text file to be skimmed")
 
 
-class ArxivRetrievalToolClass:
+class QuestionAnsweringInput(BaseModel):
+    question: str = Field(description="The question about the papers of the library")
+
+
+class CompiledTool:
+    """Base of the tool classes built on a workflow. The graph is compiled on
+    the first call and reused afterwards; one instance serves the jobs of
+    every user at once, so the first calls wait for the same compilation."""
+
+    def __init__(self, timeout=TOOL_TIMEOUT):
+        self.timeout = timeout
+        self.app = None
+        self._compile_lock = threading.Lock()
+
+    def build_workflow(self):
+        raise NotImplementedError
+
+    def _compiled(self):
+        with self._compile_lock:
+            if self.app == None:
+                self.app = self.build_workflow().create_workflow().compile()
+        return self.app
+
+
+class ArxivRetrievalToolClass(CompiledTool):
+    description = "This tool takes a string that contains a collection of articles and retrieves them from arXiv."
+    batch_description = """This tool takes a whole bibliography (one reference per line or numbered references)
+        and retrieves all of its papers from arXiv at once. Prefer it for long lists of references."""
+
     def __init__(
-        self, retriever_model=None, cleaner_model=None, receptionist_model=None
+        self,
+        retriever_model=None,
+        cleaner_model=None,
+        receptionist_model=None,
+        timeout=TOOL_TIMEOUT,
     ):
         if retriever_model == None:
-            self.retriever_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.retriever_model = get_chat_model()
         else:
             self.retriever_model = retriever_model
         if cleaner_model == None:
-            self.cleaner_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.cleaner_model = get_chat_model()
         else:
             self.cleaner_model = cleaner_model
         if receptionist_model == None:
-            self.receptionist_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.receptionist_model = get_chat_model()
         else:
             self.receptionist_model = receptionist_model
-        self.description = "This tool takes a string that contains a collection of articles and retrieves them from arXiv."
+        super().__init__(timeout)
 
     def retrieve_bib(self, text_name: str) -> str:
         """This tool takes a string that contains a collection of articles and retrieves them from arXiv."""
@@ -77,33 +117,40 @@ class ArxivRetrievalToolClass:
         input["receptionist_retriever_history"][0] = HumanMessage(
             content="Please fetch me the following papers" + text_name
         )
-        retrieve_app = ArxivRetrievalWorkflow(
+        state = run_workflow(self._compiled(), input, self.timeout)
+        return state["receptionist_retriever_history"][-1].content
+
+    def retrieve_bib_batch(self, text_name: str) -> str:
+        """This tool takes a whole bibliography and retrieves all of its papers from arXiv at once."""
+        from arxiv_batch import ArxivBatchRetriever
+
+        with cancellation_scope(run_token(self.timeout)):
+            return ArxivBatchRetriever().retrieve(text_name)
+
+    def build_workflow(self):
+        return ArxivRetrievalWorkflow(
             retriever_model=self.retriever_model,
             cleaner_model=self.cleaner_model,
             receptionist_model=self.receptionist_model,
         )
-        retrieve_app = retrieve_app.create_workflow()
-        retrieve_app = retrieve_app.compile()
-        state = retrieve_app.invoke(input)
-        return state["receptionist_retriever_history"][-1].content
 
 
-class OcrEnhancingToolClass:
-    def __init__(self, enhancer_model=None, embeder=None):
+class OcrEnhancingToolClass(CompiledTool):
+    description = """This tool takes a text in two text and improve the one using the second 
+        as a reference."""
+
+    def __init__(self, enhancer_model=None, embeder=None, timeout=TOOL_TIMEOUT):
         if enhancer_model == None:
-            self.enhancer_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.enhancer_model = get_chat_model(cached=True)
         else:
             self.enhancer_model = enhancer_model
 
         if embeder == None:
-            self.embeder = GoogleGenerativeAIEmbeddings(
-                model="models/text-embedding-004"
-            )
+            self.embeder = get_embeddings()
         else:
             self.embeder = embeder
 
-        self.description = """This tool takes a text in two text and improve the one using the second 
-        as a reference."""
+        super().__init__(timeout)
 
     def ocr_enhance(
         self, main_text_filename: str, supporting_text_filename: str
@@ -115,26 +162,35 @@ class OcrEnhancingToolClass:
             "supporting_text_filename": HumanMessage(content=supporting_text_filename),
             "report": HumanMessage(content=""),
         }
-        ocr_enchancer_app = OcrEnchancingWorkflow(
+        state = run_workflow(self._compiled(), input, self.timeout)
+        return state["report"].content
+
+    def build_workflow(self):
+        return OcrEnchancingWorkflow(
             enhancer_model=self.enhancer_model, embeder=self.embeder
         )
-        ocr_enchancer_app = ocr_enchancer_app.create_workflow()
-        ocr_enchancer_app = ocr_enchancer_app.compile()
-        state = ocr_enchancer_app.invoke(input)
-        return state["report"].content
 
 
-class ProofRemovalToolClass:
-    def __init__(self, stamper_model=None, remover_model=None):
+class ProofRemovalToolClass(CompiledTool):
+    description = "This tool takes a text in a form of a string and removes the proof section from the text."
+
+    def __init__(
+        self,
+        stamper_model=None,
+        remover_model=None,
+        max_concurrency=4,
+        timeout=TOOL_TIMEOUT,
+    ):
         if stamper_model == None:
-            self.stamper_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.stamper_model = get_chat_model(cached=True)
         else:
             self.stamper_model = stamper_model
         if remover_model == None:
-            self.remover_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.remover_model = get_chat_model(cached=True)
         else:
             self.remover_model = remover_model
-        self.description = "This tool takes a text in a form of a string and removes the proof section from the text."
+        self.max_concurrency = max_concurrency
+        super().__init__(timeout)
 
     def remove_proof(self, main_text_filename: str) -> str:
         """This tool takes a text in a form of a string and removes the proof section from the text."""
@@ -143,28 +199,38 @@ class ProofRemovalToolClass:
             "report": HumanMessage(content=""),
             "file": [""],
         }
-        proof_remover_app = ProofRemovingWorkflow(
-            stamper_model=self.stamper_model, remover_model=self.remover_model
-        )
-        proof_remover_app = proof_remover_app.create_workflow()
-        proof_remover_app = proof_remover_app.compile()
-        state = proof_remover_app.invoke(input)
+        state = run_workflow(self._compiled(), input, self.timeout)
         return state["report"].content
 
+    def build_workflow(self):
+        return ProofRemovingWorkflow(
+            stamper_model=self.stamper_model,
+            remover_model=self.remover_model,
+            max_concurrency=self.max_concurrency,
+        )
 
-class KeywordAndSummaryToolClass:
-    def __init__(self, keyword_and_summary_model=None):
-        if keyword_and_summary_model == None:
-            self.keyword_and_summary_model = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash"
-            )
-        else:
-            self.keyword_and_summary_model = keyword_and_summary_model
-        self.description = """
+
+class KeywordAndSummaryToolClass(CompiledTool):
+    description = """
         This tool takes a string that corresponds to the filename of a text.
         It processes the text in order to extract keywords and summary which it puts in a file.
         It returns the report of the process."""
 
+    def __init__(
+        self,
+        keyword_and_summary_model=None,
+        mode="fold",
+        max_concurrency=4,
+        timeout=TOOL_TIMEOUT,
+    ):
+        if keyword_and_summary_model == None:
+            self.keyword_and_summary_model = get_chat_model(cached=True)
+        else:
+            self.keyword_and_summary_model = keyword_and_summary_model
+        self.mode = mode
+        self.max_concurrency = max_concurrency
+        super().__init__(timeout)
+
     def get_keyword_and_summary(self, main_text_filename: str) -> str:
         """This tool takes a string that corresponds to the filename of a text.
         It processes the text in order to extract keywords and summary which it puts in a file.
@@ -173,26 +239,35 @@ class KeywordAndSummaryToolClass:
             "main_text_filename": HumanMessage(content=main_text_filename),
             "report": HumanMessage(content=""),
         }
-        keyword_and_summary_app = KeywordAndSummaryWorkflow()
-        keyword_and_summary_app = keyword_and_summary_app.create_workflow()
-        keyword_and_summary_app = keyword_and_summary_app.compile()
-        state = keyword_and_summary_app.invoke(input)
+        state = run_workflow(self._compiled(), input, self.timeout)
         return state["report"].content
 
+    def build_workflow(self):
+        return KeywordAndSummaryWorkflow(
+            keyword_and_summary_maker_model=self.keyword_and_summary_model,
+            mode=self.mode,
+            max_concurrency=self.max_concurrency,
+        )
 
-class TranslationToolClass:
-    def __init__(self, translator_model=None):
-        if translator_model == None:
-            self.translator_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
-        else:
-            self.translator_model = translator_model
 
-        self.description = """
+class TranslationToolClass(CompiledTool):
+    description = """
         This tool takes three strings that correspond to the filename of a text containing keywords,
         a choice of language, and the filename of a text to be translated. Then it translates it to the 
         target language and saves the result as a file on the disk. It returns a report of the process.
         """
 
+    def __init__(
+        self, translator_model=None, max_concurrency=4, timeout=TOOL_TIMEOUT
+    ):
+        if translator_model == None:
+            self.translator_model = get_chat_model(cached=True)
+        else:
+            self.translator_model = translator_model
+        self.max_concurrency = max_concurrency
+
+        super().__init__(timeout)
+
     def translate_file(
         self, auxilary_text_filename: str, target_language: str, main_text_filename: str
     ) -> str:
@@ -207,42 +282,44 @@ class TranslationToolClass:
             "main_text_filename": HumanMessage(content=main_text_filename),
             "report": HumanMessage(content=""),
         }
-        translation_app = TranslationWorkflow(translator_model=self.translator_model)
-        translation_app = translation_app.create_workflow()
-        translation_app = translation_app.compile()
-        state = translation_app.invoke(input)
+        state = run_workflow(self._compiled(), input, self.timeout)
         return state["report"].content
 
+    def build_workflow(self):
+        return TranslationWorkflow(
+            translator_model=self.translator_model,
+            max_concurrency=self.max_concurrency,
+        )
+
+
+class CitationExtractionToolClass(CompiledTool):
+    description = """This tool takes three strings that correspond to the filename of a text_file from which we want to extract the citations,
+            a type of extraction (all of them, the most important etc etc), and the filename of a text that can be used as a context for better extraction. 
+            it extracts the citations and  saves the result as a file on the disk. It returns a report of the process."""
 
-class CitationExtractionToolClass:
     def __init__(
         self,
         citation_extractor_model=None,
         citation_retriever_model=None,
         citation_cleaner_model=None,
+        max_concurrency=4,
+        timeout=TOOL_TIMEOUT,
     ):
         if citation_extractor_model == None:
-            self.citation_extractor_model = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash"
-            )
+            self.citation_extractor_model = get_chat_model(cached=True)
         else:
             self.citation_extractor_model = citation_extractor_model
         if citation_retriever_model == None:
-            self.citation_retriever_model = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash"
-            )
+            self.citation_retriever_model = get_chat_model(cached=True)
         else:
             self.citation_retriever_model = citation_retriever_model
         if citation_cleaner_model == None:
-            self.citation_cleaner_model = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash"
-            )
+            self.citation_cleaner_model = get_chat_model(cached=True)
         else:
             self.citation_cleaner_model = citation_cleaner_model
+        self.max_concurrency = max_concurrency
 
-        self.description = """This tool takes three strings that correspond to the filename of a text_file from which we want to extract the citations,
-            a type of extraction (all of them, the most important etc etc), and the filename of a text that can be used as a context for better extraction. 
-            it extracts the citations and  saves the result as a file on the disk. It returns a report of the process."""
+        super().__init__(timeout)
 
     def extract_citations(
         self, main_text_filename: str, extraction_type: str, auxilary_text_filename: str
@@ -253,98 +330,190 @@ class CitationExtractionToolClass:
             "auxilary_text_filename": HumanMessage(content=auxilary_text_filename),
             "report": HumanMessage(content=""),
         }
-        citation_extraction_app = CitationExtractionWorkflow(
-            citation_extractor_model=self.citation_extractor_model
-        )
-        citation_extraction_app = citation_extraction_app.create_workflow()
-        citation_extraction_app = citation_extraction_app.compile()
-        state = citation_extraction_app.invoke(input)
+        state = run_workflow(self._compiled(), input, self.timeout)
         return state["report"].content
 
+    def build_workflow(self):
+        return CitationExtractionWorkflow(
+            citation_extractor_model=self.citation_extractor_model,
+            citation_retriever_model=self.citation_retriever_model,
+            citation_cleaner_model=self.citation_cleaner_model,
+            max_concurrency=self.max_concurrency,
+        )
 
-class TakeAPeakToolClass:
-    def __init__(self, take_a_peak_model=None):
+
+class TakeAPeakToolClass(CompiledTool):
+    description = """
+        This tool takes a string that corresponds to the filename of a text. 
+        It skimms it and returns with a quick report"""
+
+    def __init__(self, take_a_peak_model=None, timeout=TOOL_TIMEOUT):
         if take_a_peak_model == None:
-            self.take_a_peak_model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+            self.take_a_peak_model = get_chat_model(cached=True)
         else:
             self.take_a_peak_model = take_a_peak_model
-        self.description = """
-        This tool takes a string that corresponds to the filename of a text. 
-        It skimms it and returns with a quick report"""
+        super().__init__(timeout)
 
     def take_a_peak(self, main_text_filename: str) -> str:
         input = {
             "main_text_filename": HumanMessage(content=main_text_filename),
             "report": HumanMessage(content=""),
         }
-        take_a_peak_app = TakeAPeakWorkflow(take_a_peak_model=self.take_a_peak_model)
-        take_a_peak_app = take_a_peak_app.create_workflow()
-        take_a_peak_app = take_a_peak_app.compile()
-        state = take_a_peak_app.invoke(input)
+        state = run_workflow(self._compiled(), input, self.timeout)
         return state["report"].content
 
+    def build_workflow(self):
+        return TakeAPeakWorkflow(take_a_peak_model=self.take_a_peak_model)
+
+
+class QuestionAnsweringToolClass(CompiledTool):
+    description = """
+        This tool takes a question about the papers in the local library (every
+        markdown in files/markdowns) and answers it from the most relevant
+        passages, citing the paper and page of each one."""
+
+    def __init__(
+        self, answering_model=None, namespace="default", timeout=TOOL_TIMEOUT
+    ):
+        if answering_model == None:
+            self.answering_model = get_chat_model(cached=True)
+        else:
+            self.answering_model = answering_model
+        # The index of the shared library, see retrieval_index
+        self.namespace = namespace
+        super().__init__(timeout)
+
+    def answer_question(self, question: str) -> str:
+        input = {
+            "question": HumanMessage(content=question),
+            "report": HumanMessage(content=""),
+        }
+        state = run_workflow(self._compiled(), input, self.timeout)
+        return state["report"].content
+
+    def build_workflow(self):
+        from retrieval_index import HybridIndex
+
+        return QuestionAnsweringWorkflow(
+            answering_model=self.answering_model,
+            index=HybridIndex(namespace=self.namespace, embedder=get_embeddings()),
+        )
+
+
+def run_token(timeout=None):
+    """A token for one run of a tool, with its deadline; inside a job it also
+    stops when the job is cancelled."""
+    return CancellationToken(timeout=timeout, parent=current_token.get())
+
+
+def run_workflow(app, input, timeout=None):
+    """Invokes the compiled workflow with a token of its own, handed to the
+    nodes through the LangGraph config and the current context."""
+    token = run_token(timeout)
+    with cancellation_scope(token):
+        return app.invoke(
+            input, config={"configurable": {"cancellation_token": token}}
+        )
+
+
+tool_instances = {}
+tool_instances_lock = threading.Lock()
+
+
+def lazy_tool(tool_class, method_name):
+    """Returns a function that builds the tool class (and with it the models) on
+    its first call only. The same instance serves every later call."""
+
+    def run(**kwargs):
+        with tool_instances_lock:
+            if tool_class not in tool_instances:
+                tool_instances[tool_class] = tool_class()
+            instance = tool_instances[tool_class]
+        try:
+            return getattr(instance, method_name)(**kwargs)
+        except RunCancelled as e:
+            # The supervisor gets a report, not a traceback
+            return (
+                f"Stopped before the end: {e}. The finished chunks are saved; "
+                "running the same tool again resumes from them."
+            )
+
+    run.__name__ = method_name
+    run.__doc__ = getattr(tool_class, method_name).__doc__
+    return run
+
 
 def create_tools():
-    TranslationTool = TranslationToolClass()
+    """The tools are registered by their schema and description alone; nothing
+    is built until the supervisor calls them."""
     TranslationTool = StructuredTool(
         name="TranslationTool",
-        func=TranslationTool.translate_file,
+        func=lazy_tool(TranslationToolClass, "translate_file"),
         args_schema=TranslationInput,
-        description=TranslationTool.description,
+        description=TranslationToolClass.description,
     )
-    ArxivRetrievalTool = ArxivRetrievalToolClass()
     ArxivRetrievalTool = StructuredTool(
         name="ArxivRetrievalTool",
-        func=ArxivRetrievalTool.retrieve_bib,
+        func=lazy_tool(ArxivRetrievalToolClass, "retrieve_bib"),
         args_schema=ArxivRetrievalInput,
-        description=ArxivRetrievalTool.description,
+        description=ArxivRetrievalToolClass.description,
+    )
+    ArxivBatchRetrievalTool = StructuredTool(
+        name="ArxivBatchRetrievalTool",
+        func=lazy_tool(ArxivRetrievalToolClass, "retrieve_bib_batch"),
+        args_schema=ArxivRetrievalInput,
+        description=ArxivRetrievalToolClass.batch_description,
     )
-    OcrEnhancingTool = OcrEnhancingToolClass()
     OcrEnhancingTool = StructuredTool(
         name="OcrEnhancingTool",
-        func=OcrEnhancingTool.ocr_enhance,
+        func=lazy_tool(OcrEnhancingToolClass, "ocr_enhance"),
         args_schema=OcrEnhancingInput,
-        description=OcrEnhancingTool.description,
+        description=OcrEnhancingToolClass.description,
     )
 
-    ProofRemoverTool = ProofRemovalToolClass()
     ProofRemoverTool = StructuredTool(
         name="ProofRemovalTool",
-        func=ProofRemoverTool.remove_proof,
+        func=lazy_tool(ProofRemovalToolClass, "remove_proof"),
         args_schema=ProofRemovalInput,
-        description=ProofRemoverTool.description,
+        description=ProofRemovalToolClass.description,
     )
 
-    KeywordAndSummaryTool = KeywordAndSummaryToolClass()
     KeywordAndSummaryTool = StructuredTool(
         name="KeywordAndSummaryTool",
-        func=KeywordAndSummaryTool.get_keyword_and_summary,
+        func=lazy_tool(KeywordAndSummaryToolClass, "get_keyword_and_summary"),
         args_schema=KeywordSummaryCreationInput,
-        description=KeywordAndSummaryTool.description,
+        description=KeywordAndSummaryToolClass.description,
     )
-    CitationExtractionTool = CitationExtractionToolClass()
     CitationExtractionTool = StructuredTool(
         name="CitationExtractionTool",
-        func=CitationExtractionTool.extract_citations,
+        func=lazy_tool(CitationExtractionToolClass, "extract_citations"),
         args_schema=CitationExtractionInput,
-        description=CitationExtractionTool.description,
+        description=CitationExtractionToolClass.description,
     )
-    TakeAPeakTool = TakeAPeakToolClass()
     TakeAPeakTool = StructuredTool(
         name="TakeAPeakTool",
-        func=TakeAPeakTool.take_a_peak,
+        func=lazy_tool(TakeAPeakToolClass, "take_a_peak"),
         args_schema=TakeAPeakInput,
-        description=TakeAPeakTool.description,
+        description=TakeAPeakToolClass.description,
+    )
+    QuestionAnsweringTool = StructuredTool(
+        name="QuestionAnsweringTool",
+        func=lazy_tool(QuestionAnsweringToolClass, "answer_question"),
+        args_schema=QuestionAnsweringInput,
+        description=QuestionAnsweringToolClass.description,
     )
 
     tools = [
         TranslationTool,
         ArxivRetrievalTool,
+        ArxivBatchRetrievalTool,
         OcrEnhancingTool,
         ProofRemoverTool,
         KeywordAndSummaryTool,
         pdf_to_markdown,
+        pdf_to_markdown_vision,
         CitationExtractionTool,
         TakeAPeakTool,
+        QuestionAnsweringTool,
     ]
     return tools